@@ -16,7 +16,14 @@ pip install --upgrade pip
 pip install -r requirements.txt --upgrade
 #Include extra packages already found in the amazon environment so we can run locally
 pip install -r requirements_venv_local.txt --upgrade
-$PYTHON_VERSION update_config.py
+# ASSET_PACK=1 ./lambda_package.sh also builds the pre-decoded asset pack,
+# it is ~800MB so only use it where the package size limit allows (container images)
+if [ "$ASSET_PACK" = "1" ]; then
+    $PYTHON_VERSION update_config.py --asset-pack
+else
+    rm -f purerackdiagram/assets.pack
+    $PYTHON_VERSION update_config.py
+fi
 deactivate
 
 # Now for the one that will send to amazon
@@ -28,6 +35,6 @@ deactivate
 cd $VENV/lib/$PYTHON_VERSION/site-packages
 zip -r -y ../../../../lambda.zip yaml jsonurl_py.py --exclude '*.pyc' --exclude '*__pycache__*'
 cd ../../../../
-zip -r -y lambda.zip lambdaentry.py purerackdiagram vssx -i '*.png' '*.py' '*.ttf' '*.yaml' '*.xml' '*.zip'
+zip -r -y lambda.zip lambdaentry.py purerackdiagram vssx -i '*.png' '*.py' '*.ttf' '*.yaml' '*.xml' '*.zip' '*.pack' '*.pickle'
 
 
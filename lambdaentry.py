@@ -2,26 +2,59 @@ import time
 from io import BytesIO
 import asyncio
 import base64
+import functools
 import logging
 import os
+import tempfile
 import uuid
 import zipfile
 import io
 import json
 import traceback
+from types import SimpleNamespace
 
 import boto3
 from PIL import Image, ImageDraw, ImageFont
 
-from purerackdiagram.utils import combine_images_vertically
+from purerackdiagram.utils import combine_images_vertically, vertical_layout, fit_scale, scale_ports, render_scale, pixels_id
+from purerackdiagram.utils import stack_layout, scaled_size
+from purerackdiagram.pngwriter import write_png_vertically, get_encode_executor
+from purerackdiagram.encoders import encoders, encode_image, format_param_get
+from purerackdiagram.resultcache import ResultCache, code_version
+from purerackdiagram.canonical import canonical_config
 import purerackdiagram
 from purerackdiagram.utils import RackDiagramException, InvalidConfigurationException, InvalidDatapackException, MockImage, bool_param_get
+from purerackdiagram.utils import cache as asset_cache, get_decode_metrics
+from purerackdiagram.componentcache import component_cache
 
 # Configure logging for Lambda
 logger = logging.getLogger()
 bucket_name = "images.purestorage"
 
 use_s3_size_limit = 4  # MiB limit for inline responses
+max_image_height = 4604  # taller images are scaled down to this height
+
+# write combined PNGs a band at a time instead of building the whole image,
+# only used when the image doesn't need ports drawn on it or resizing.
+stream_png = os.environ.get('RACKDIAGRAM_STREAM_PNG', '').lower() in ('1', 'true', 'yes')
+
+# finished responses are cached by their params, in memory and on disk in
+# /tmp when running in lambda.  The version covers this file as well as the
+# package so a deploy never serves results rendered by older code.
+result_cache_mb = int(os.environ.get('RACKDIAGRAM_RESULT_CACHE_MB', 64))
+result_cache_dir = os.environ.get('RACKDIAGRAM_RESULT_CACHE_DIR',
+                                  '/tmp/rackdiagram-results' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else '')
+result_cache_disk_mb = int(os.environ.get('RACKDIAGRAM_RESULT_CACHE_DISK_MB', 256))
+result_cache_enabled = result_cache_mb > 0 or bool(result_cache_dir)
+result_cache = ResultCache(result_cache_mb * 1024 * 1024,
+                           disk_dir=result_cache_dir or None,
+                           disk_bytes=result_cache_disk_mb * 1024 * 1024,
+                           version=code_version([os.path.abspath(__file__)]))
+
+# compose images taller than max_image_height straight at the reduced size
+# rather than building them full size and resizing, the pixels differ from
+# the full size resize along the seams between components.
+scaled_compose = os.environ.get('RACKDIAGRAM_SCALED_COMPOSE', '').lower() in ('1', 'true', 'yes')
 
 # Set to DEBUG to see more details in CloudWatch
 log_level = 'WARNING'
@@ -117,18 +150,30 @@ def emit_exception_metric(exception_type):
 VERSION = 5
 program_time_s = time.time()
 
+# Decode assets during the init phase, before the first request (and before
+# billing starts with provisioned concurrency).  Comma separated list of
+# anything purerackdiagram.preload accepts, e.g. "fa-x,fa-c,fb-s" or "all".
+preload_targets = os.environ.get('RACKDIAGRAM_PRELOAD', '')
+if preload_targets:
+    try:
+        purerackdiagram.preload(preload_targets)
+    except Exception as e:
+        logger.error(f"Failed to preload {preload_targets}: {str(e)}")
+
 def upload_to_s3(buffered, extension, contenttype, disposition):
     s3 = boto3.client('s3')
     unique_key = str(uuid.uuid4())
     file_key = f"cache/{unique_key}.{extension}"
     buffered.seek(0)
     try:
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=file_key,
-            Body=buffered.getvalue(),
-            ContentType=contenttype,
-            ContentDisposition=disposition
+        # streams the file (in parts when it's big) rather than reading it
+        # all into one request body
+        s3.upload_fileobj(
+            buffered,
+            bucket_name,
+            file_key,
+            ExtraArgs={'ContentType': contenttype,
+                       'ContentDisposition': disposition}
         )
         logger.info(f"Successfully uploaded to S3: {file_key}")
     except Exception as e:
@@ -180,90 +225,135 @@ def sort_ports(all_ports):
     return sorted(all_ports, key=port_key)
 
 
-def draw_ports_on_image(img, all_ports, draw_ports_flag, img_original_size):
-    draw = ImageDraw.Draw(img)
-    size = 16
+def port_symbol(p):
+    """The (name, shape, color) of the symbol for port p, None if it doesn't get one"""
+    services = p.get('services', [])
+    if 'management' in services and len(services) == 1:
+        return "Management", "triangle_up", '#00B2A9'
+    elif services and services[0] == 'replication':
+        return "Replication", "triangle_up", '#934DD6'
+    elif 'port_type' not in p:
+        return None
+    elif p['port_type'] == 'sas':
+        return "SAS", "rectangle", 'blue'
+    elif services and services[0] == 'shelf':
+        return "Shelf", "triangle_down", '#FCDC4D'
+    elif p['port_type'] == 'fc':
+        return "Fibre Channel", "square", '#FE5000'
+    elif p['port_type'] == 'eth_roce':
+        return "Ethernet / RoCE", "triangle_up", "#FD9627"
+    elif p['port_type'] == 'eth':
+        return "Ethernet", "triangle_up", '#D90368'
+    logger.warning(f"Unknown port type: {p['port_type']}")
+    return None
+
+
+def add_port_symbols(all_ports):
+    """Adds the symbol_name, symbol_shape and symbol_color of each port"""
     for p in all_ports:
-        services = p.get('services', [])
-        if 'management' in services and len(services) == 1:
-            color = '#00B2A9'
-            if draw_ports_flag:
-                draw_triangle_up(draw, p['loc'][0], p['loc'][1], size, color)
-            p['symbol_name'] = "Management"
-            p['symbol_shape'] = "triangle_up"
-            p['symbol_color'] = color
-
-        elif services and services[0] == 'replication':
-            color = '#934DD6'
-            if draw_ports_flag:
-                draw_triangle_up(draw, p['loc'][0], p['loc'][1], size, color)
-            p['symbol_name'] = "Replication"
-            p['symbol_shape'] = "triangle_up"
-            p['symbol_color'] = color
-
-        elif 'port_type' not in p:
-            continue
+        symbol = port_symbol(p)
+        if symbol is not None:
+            p['symbol_name'], p['symbol_shape'], p['symbol_color'] = symbol
 
-        elif p['port_type'] == 'sas':
-            color = 'blue'
-            if draw_ports_flag:
-                draw.rectangle((p['loc'][0] - size, p['loc'][1] - size/2,
-                                p['loc'][0] + size, p['loc'][1] + size/2),
-                               fill=color, outline=color)
-            p['symbol_name'] = "SAS"
-            p['symbol_shape'] = "rectangle"
-            p['symbol_color'] = color
-
-        elif services and services[0] == 'shelf':
-            color = '#FCDC4D'
-            if draw_ports_flag:
-                draw_triangle_down(draw, p['loc'][0], p['loc'][1], size, color)
-            p['symbol_name'] = "Shelf"
-            p['symbol_shape'] = "triangle_down"
-            p['symbol_color'] = color
-
-        elif p['port_type'] == 'fc':
-            color = '#FE5000'
-            if draw_ports_flag:
-                draw.rectangle((p['loc'][0] - size, p['loc'][1] - size,
-                                p['loc'][0] + size, p['loc'][1] + size),
-                               fill=color, outline=color)
-            p['symbol_name'] = "Fibre Channel"
-            p['symbol_shape'] = "square"
-            p['symbol_color'] = color
-
-        elif p['port_type'] == 'eth_roce':
-            color = "#FD9627"
-            if draw_ports_flag:
-                draw_triangle_up(draw, p['loc'][0], p['loc'][1], size, color)
-            p['symbol_name'] = "Ethernet / RoCE"
-            p['symbol_shape'] = "triangle_up"
-            p['symbol_color'] = color
-
-        elif p['port_type'] == 'eth':
-            color = '#D90368'
-            if draw_ports_flag:
-                draw_triangle_up(draw, p['loc'][0], p['loc'][1], size, color)
-            p['symbol_name'] = "Ethernet"
-            p['symbol_shape'] = "triangle_up"
-            p['symbol_color'] = color
 
-        else:
-            logger.warning(f"Unknown port type: {p['port_type']}")
+def draw_ports_on_image(img, all_ports, draw_ports_flag, img_original_size, symbol_size=16):
+    add_port_symbols(all_ports)
+    if not draw_ports_flag:
+        return
+
+    draw = ImageDraw.Draw(img)
+    size = symbol_size
+    for p in all_ports:
+        shape = p.get('symbol_shape')
+        if shape is None:
+            continue
+        color = p['symbol_color']
+        x, y = p['loc']
+        if shape == "triangle_up":
+            draw_triangle_up(draw, x, y, size, color)
+        elif shape == "triangle_down":
+            draw_triangle_down(draw, x, y, size, color)
+        elif shape == "rectangle":
+            draw.rectangle((x - size, y - size/2, x + size, y + size/2),
+                           fill=color, outline=color)
+        elif shape == "square":
+            draw.rectangle((x - size, y - size, x + size, y + size),
+                           fill=color, outline=color)
+
+
+def get_render_scale(params, img_ports):
+    """The scale to compose img_ports at for the scale and max_width params"""
+    return size_render_scale(params, vertical_layout(img_ports)[0])
+
+
+def size_render_scale(params, size):
+    """The scale to compose an image of size at for the scale and max_width params"""
+    scale = render_scale(params, size)
+    if scale < 1.0:
+        # straight to the final size rather than scaling twice
+        scale = min(scale, fit_scale(size, max_image_height))
+    return scale
+
+
+def layout_size_and_ports(diagram, params):
+    """The size and ports of the combined (and scaled) image, worked out
+    from the diagram's config without building any images, see layout()"""
+    components = [(c['size'], c['ports']) for c in diagram.layout()]
+    size, _, all_ports = stack_layout(components)
+    scale = size_render_scale(params, size)
+    if scale != 1.0:
+        size = scaled_size(size, scale)
+        scale_ports(all_ports, scale)
+    return size, all_ports
+
+
+def pipeline_size_and_ports(diagram, params):
+    """The size and ports of the combined (and scaled) image from
+    get_image() in json_only mode, MockImages in place of the images"""
+    img_ports_list = asyncio.run(diagram.get_image())
+    scale = get_render_scale(params, img_ports_list)
+    final_img, all_ports = combine_images_vertically(img_ports_list, scale)
+    return final_img.size, all_ports
+
+
+def fit_size_and_ports(size, all_ports):
+    """The size an image of size is brought down to, max_image_height high at
+    most, all_ports are moved to match"""
+    max_height = max_image_height
+    if size[1] > max_height:
+        wpercent = fit_scale(size, max_height)
+        hsize = int((float(size[0]) * float(wpercent)))
+        scale_ports(all_ports, wpercent)
+        return (hsize, max_height)
+    return size
 
 
 def resize_image_and_ports(img, all_ports):
-    max_height = 4604
-    if img.size[1] > max_height:
-        wpercent = (max_height / float(img.size[1]))
-        hsize = int((float(img.size[0]) * float(wpercent)))
-        img = img.resize((hsize, max_height), Image.Resampling.LANCZOS)
-        for p in all_ports:
-            p['loc'] = (int(p['loc'][0] * wpercent), int(p['loc'][1] * wpercent))
+    size = fit_size_and_ports(img.size, all_ports)
+    if size != img.size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
     return img
 
 
-def create_vssx_for_image(img, all_ports, diagram, params):
+@functools.lru_cache(maxsize=1)
+def load_vssx_templates():
+    """The stencil zip and the two master xml templates, read once per container"""
+    root_path = os.path.dirname(__file__)
+    vssx_path = os.path.join(root_path, "vssx/vssx_template.zip")
+    master1_template_path = os.path.join(root_path, "vssx/master1_template.xml")
+    masters_template_path = os.path.join(root_path, "vssx/masters_template.xml")
+
+    with open(vssx_path, 'rb') as vssx_file:
+        zipfile_raw = vssx_file.read()
+    with open(master1_template_path, 'r') as mf:
+        master1 = mf.read()
+    with open(masters_template_path, 'r') as mf:
+        masters = mf.read()
+    return zipfile_raw, master1, masters
+
+
+def create_vssx_for_image(img, all_ports, diagram, params, png_bytes=None):
+    """Builds the stencil for img, png_bytes is img already saved as a PNG if there is one"""
     ru = diagram.config['ru']
     h_inches = "{:.2f}".format(ru*1.75)
     if params['model'] == 'fb':
@@ -286,10 +376,7 @@ def create_vssx_for_image(img, all_ports, diagram, params):
     for n in items:
         name += "_"+str(diagram.config[n])
 
-    root_path = os.path.dirname(__file__)
-    vssx_path = os.path.join(root_path, "vssx/vssx_template.zip")
-    master1_template_path = os.path.join(root_path, "vssx/master1_template.xml")
-    masters_template_path = os.path.join(root_path, "vssx/masters_template.xml")
+    zipfile_raw, master1, masters = load_vssx_templates()
 
     img_original_size = img.size
     connection_template = """
@@ -304,42 +391,34 @@ def create_vssx_for_image(img, all_ports, diagram, params):
                 </Row>
                 """
     ix = 2
-    connection_points = ""
+    connection_points = []
     for p in all_ports:
         x_w = 1.0 * (p['loc'][0] / img_original_size[0])
         x_in = 19 * x_w
         y_h = 1 - 1.0 * (p['loc'][1] / img_original_size[1])
         y_in = ru * 1.75 * y_h
-        connection_points += connection_template.format(ix, x_in, x_w, y_in, y_h)
+        connection_points.append(connection_template.format(ix, x_in, x_w, y_in, y_h))
         ix += 1
-
-    master1 = None
-    with open(master1_template_path, 'r') as mf:
-        master1 = mf.read()
+    connection_points = "".join(connection_points)
 
     master1 = master1.replace('<template_h_in>', h_inches)
     master1 = master1.replace('<template_h_u>', str(ru))
     master1 = master1.replace('<template_name>', stencil_name)
     master1 = master1.replace('<additional_connection_points>', connection_points)
 
-    masters = None
-    with open(masters_template_path, 'r') as mf:
-        masters = mf.read()
     stamp = int((time.time())*10)
     unique_id = f"{stamp:07X}"[-7:]
     masters = masters.replace('<template_unique_id>', unique_id)
     masters = masters.replace('<template_name>', stencil_name)
 
-    buffered_image = BytesIO()
-    img.save(buffered_image, format="PNG")
-    buffered_image.seek(0)
-
-    with open(vssx_path, 'rb') as vssx_file:
-        zipfile_raw = vssx_file.read()
+    if png_bytes is None:
+        buffered_image, _ = encode_image(img, 'png')
+        png_bytes = buffered_image.getvalue()
 
+    # appended to a copy of the template, the template itself is shared
     zipfile_buffered = io.BytesIO(zipfile_raw)
     with zipfile.ZipFile(zipfile_buffered, 'a') as zipf:
-        zipf.writestr('visio/media/image1.png', buffered_image.getvalue())
+        zipf.writestr('visio/media/image1.png', png_bytes)
         zipf.writestr('visio/masters/master1.xml', master1)
         zipf.writestr('visio/masters/masters.xml', masters)
 
@@ -347,6 +426,34 @@ def create_vssx_for_image(img, all_ports, diagram, params):
     return name, zipfile_buffered
 
 
+def render_component(component, draw_ports_flag, vssx_flag, fmt, diagram, params):
+    """Draws, scales and encodes one component.
+
+    Returns a function giving the zip member name for the component's index
+    and the member's bytes.
+    """
+    # component is expected to be {'img':..., 'ports':...}
+    img = component['img']
+    all_ports = component['ports']
+
+    if all_ports:
+        all_ports = sort_ports(all_ports)
+    draw_ports_on_image(img, all_ports, draw_ports_flag, img.size)
+    scale = get_render_scale(params, [component])
+    if scale < 1.0:
+        img = img.resize((int(img.size[0] * scale), int(round(img.size[1] * scale))),
+                         Image.Resampling.LANCZOS, reducing_gap=1.0)
+        scale_ports(all_ports, scale)
+    img = resize_image_and_ports(img, all_ports)
+
+    if vssx_flag:
+        name, vssx_buffer = create_vssx_for_image(img, all_ports, diagram, params)
+        return lambda index: f"{name}_{index}.vssx", vssx_buffer.getvalue()
+
+    buffered, encoding = encode_image(img, fmt, use_s3_size_limit * 1024 * 1024)
+    return lambda index: f"component_{index}.{encoding['extension']}", buffered.getvalue()
+
+
 def handle_individual_processing(img_ports, diagram, params):
     draw_ports_flag = False
     if 'ports' in params and (
@@ -356,35 +463,35 @@ def handle_individual_processing(img_ports, diagram, params):
         draw_ports_flag = True
 
     vssx_flag = 'vssx' in params and params['vssx']
-
-    memory_zip = BytesIO()
-    with zipfile.ZipFile(memory_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        index = 1
-        for component in img_ports:
-            # component is expected to be {'img':..., 'ports':...}
-            img = component['img']
-            all_ports = component['ports']
-
-            if all_ports:
-                all_ports = sort_ports(all_ports)
-            draw_ports_on_image(img, all_ports, draw_ports_flag, img.size)
-            img = resize_image_and_ports(img, all_ports)
-
-            if vssx_flag:
-                name, vssx_buffer = create_vssx_for_image(img, all_ports, diagram, params)
-                filename = f"{name}_{index}.vssx"
-                zipf.writestr(filename, vssx_buffer.getvalue())
-            else:
-                buffered = BytesIO()
-                img.save(buffered, format="PNG")
-                filename = f"component_{index}.png"
-                zipf.writestr(filename, buffered.getvalue())
-            index += 1
-
-    memory_zip.seek(0)
-    zip_file_size = len(memory_zip.getvalue()) / (1024*1024)
+    fmt = format_param_get(params)
+
+    # components are drawn and encoded on the encode pool, the members are
+    # already compressed (png, vssx ...) so they are stored rather than
+    # deflated again.  The zip spills to /tmp once it's too big to return
+    # inline, it's going to S3 then anyway.
+    # identical components (full chassis, shelves, the XFMs) share their
+    # pixels and have the same ports, each is only drawn and encoded once
+    executor = get_encode_executor()
+    unique = {}
+    futures = []
+    for component in img_ports:
+        key = (pixels_id(component['img']), json.dumps(component['ports'], sort_keys=True, default=str))
+        if key not in unique:
+            unique[key] = executor.submit(render_component, component, draw_ports_flag,
+                                          vssx_flag, fmt, diagram, params)
+        futures.append(unique[key])
+
+    spooled_zip = tempfile.SpooledTemporaryFile(max_size=use_s3_size_limit * 1024 * 1024)
+    with zipfile.ZipFile(spooled_zip, 'w', zipfile.ZIP_STORED) as zipf:
+        for index, future in enumerate(futures, start=1):
+            member_name, data = future.result()
+            zipf.writestr(member_name(index), data)
+
+    zip_file_size = spooled_zip.tell() / (1024*1024)
+    spooled_zip.seek(0)
     if zip_file_size > use_s3_size_limit:
-        link = upload_to_s3(memory_zip, "zip", "application/zip", 'attachment; filename="components.zip"')
+        link = upload_to_s3(spooled_zip, "zip", "application/zip", 'attachment; filename="components.zip"')
+        spooled_zip.close()
         return {
             "statusCode": 302,
             "headers": {
@@ -394,7 +501,8 @@ def handle_individual_processing(img_ports, diagram, params):
             }
         }
 
-    zip_str = base64.b64encode(memory_zip.getvalue()).decode('utf-8')
+    with spooled_zip:
+        zip_str = base64.b64encode(spooled_zip.read()).decode('utf-8')
     return {
         "statusCode": 200,
         "body": zip_str,
@@ -549,7 +657,116 @@ def create_response(status_code, body, headers=None, is_base64_encoded=False, pa
         
     return response
 
+def handle_warmup(event):
+    """Preload assets without rendering anything.
+
+    The event is {"warmup": targets}, targets is anything purerackdiagram.preload
+    accepts, or true to preload RACKDIAGRAM_PRELOAD (everything if that isn't set).
+    No success metric is emitted, warm ups aren't usage.
+    """
+    targets = event["warmup"]
+    if targets is True or targets in ("true", ""):
+        targets = preload_targets or "all"
+
+    keys = purerackdiagram.preload(targets)
+    load_vssx_templates()
+    logger.info(f"Warm up preloaded {len(keys)} assets")
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "warmup": len(keys),
+            "execution_duration": time.time() - program_time_s,
+            "asset_cache": asset_cache.stats(),
+        }),
+        "headers": {
+            "Content-Type": "application/json",
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET'
+        }
+    }
+
+
+def canonical_request(params):
+    """The request params in canonical form, equal for requests that get the same response.
+
+    The diagram is the canonical config FADiagram, FBDiagram or FBSDiagram
+    resolve the params to, the options read here are resolved the way
+    render_request() reads them.  JSON responses echo the params as they
+    were sent and stencils are named after the model and datapacks, so
+    those are kept as given.
+    """
+    render_params = dict(params)
+    json_only_mode = bool_param_get(render_params, 'json_only', False)
+    if json_only_mode:
+        render_params['json_only'] = True
+    diagram = purerackdiagram.get_diagram(render_params)
+
+    ports = params.get('ports', False)
+    vssx_flag = bool('vssx' in params and params['vssx'])
+    json_param = bool_param_get(params, 'json', False)
+    canonical = {
+        'diagram': canonical_config(diagram.config),
+        'json_only': json_only_mode,
+        'ports': ports == True or str(ports).upper() in ("TRUE", "YES"),
+        'individual': 'individual' in params,
+        'vssx': vssx_flag,
+        'json': json_param,
+        'format': format_param_get(params),
+    }
+    for name in ('scale', 'max_width'):
+        if str(params.get(name, '')).strip() != '':
+            canonical[name] = float(params[name])
+    if json_only_mode or json_param:
+        # in the order they were sent, that's how they're echoed
+        canonical['params'] = [[k, v] for k, v in params.items()]
+    if vssx_flag:
+        canonical['name'] = [render_params['model'], render_params.get('datapacks')]
+    return canonical
+
+
+def cached_response(event):
+    """The cache key for a request and its cached response if there is one"""
+    if not result_cache_enabled or "warmup" in event:
+        return None, None
+    params = event.get("queryStringParameters")
+    if not params:
+        return None, None
+    try:
+        key = result_cache.key(canonical_request(params))
+    except Exception:
+        # bad params, the render reports the error and it isn't cached
+        return None, None
+    return key, result_cache.get(key)
+
+
 def handler(event, context):
+    """Serves a request from the result cache, renders it if it isn't there"""
+    key, cached = cached_response(event)
+    if cached is not None:
+        logger.info("Serving cached result")
+        # the same usage metrics a render reports
+        emit_success_metric()
+        emit_array_type_metric(event["queryStringParameters"],
+                               SimpleNamespace(config=cached['metric_config']))
+        response = dict(cached['response'])
+        response['headers'] = dict(response['headers'])
+        return response
+
+    rendered = {}
+    response = render_request(event, context, rendered)
+
+    # only finished, inline results, redirects point at S3 objects that
+    # expire and errors should be retried
+    if key is not None and response.get('statusCode') == 200 and 'diagram' in rendered:
+        config = rendered['diagram'].config
+        metric_config = {k: config.get(k, '') for k in ('generation', 'release', 'model_num')}
+        stored = dict(response, headers=dict(response['headers']))
+        result_cache.put(key, {'response': stored, 'metric_config': metric_config})
+    return response
+
+
+def render_request(event, context, rendered):
+    """Renders the request in event, rendered['diagram'] is set to the diagram"""
     global program_time_s
     program_time_s = time.time()
     params = {}
@@ -561,6 +778,9 @@ def handler(event, context):
         request_id = context.aws_request_id if context and hasattr(context, 'aws_request_id') else 'unknown'
         logger.info(f"Lambda invoked with request_id: {request_id}")
         logger.debug(f"Full event: {json.dumps(event)}")
+
+        if "warmup" in event:
+            return handle_warmup(event)
         
         if ("queryStringParameters" not in event
                 or event["queryStringParameters"] is None):
@@ -583,36 +803,38 @@ def handler(event, context):
             params['json_only'] = True
         
         diagram = purerackdiagram.get_diagram(params)
+        rendered['diagram'] = diagram
         logger.info(f"Diagram created: {diagram}")
         
-        img_ports_list = asyncio.run(diagram.get_image())
-        logger.info("Images created successfully")
-        
         # If json_only mode, return early with just port data
         if json_only_mode:
-            # Combine the ports from all image_ports
-            final_img, all_ports = combine_images_vertically(img_ports_list)
+            # Combine the ports from all components, where they are in the
+            # scaled image if a scale was asked for.  The layout is plain
+            # arithmetic on the config, anything it can't work out goes
+            # through the images the way it always has.
+            try:
+                image_size, all_ports = layout_size_and_ports(diagram, params)
+            except Exception as e:
+                logger.debug(f"Layout unavailable, building the images: {e}")
+                # the layout may have got part way through the datapacks
+                diagram = purerackdiagram.get_diagram(params)
+                rendered['diagram'] = diagram
+                image_size, all_ports = pipeline_size_and_ports(diagram, params)
             if all_ports:
                 all_ports = sort_ports(all_ports)
-            
-            # Add port symbols for consistency with regular JSON mode
-            draw_ports_flag = False
-            if 'ports' in params and (
-                params['ports'] == True or
-                params['ports'].upper() == "TRUE"
-                or params['ports'].upper() == "YES"):
-                draw_ports_flag = True
-            
-            draw_ports_on_image(final_img, all_ports, draw_ports_flag, final_img.size)
-            final_img = resize_image_and_ports(final_img, all_ports)
-            
+
+            # Add port symbols for consistency with regular JSON mode,
+            # there's no image to draw them on
+            add_port_symbols(all_ports)
+            image_size = fit_size_and_ports(image_size, all_ports)
+
             data = {
                 "image_type": "json_only",
                 "config": diagram.config,
                 "ports": all_ports,
                 "execution_duration": time.time() - program_time_s,
                 "error": None,
-                "image_size": final_img.size,
+                "image_size": image_size,
                 "image_mib": 0,
                 "params": original_params,
                 "image": None
@@ -626,6 +848,10 @@ def handler(event, context):
                 diagram=diagram
             )
 
+        img_ports_list = asyncio.run(diagram.get_image())
+        logger.info("Images created successfully")
+        logger.debug(f"Asset cache: {asset_cache.stats()} decode: {get_decode_metrics()} components: {component_cache.stats()}")
+
         # Check for "individual" param
         individual = False
         if 'individual' in params:
@@ -635,9 +861,6 @@ def handler(event, context):
             # img_ports_list expected as a list of dict, each containing 'img' and 'ports'
             return handle_individual_processing(img_ports_list, diagram, params)
 
-        # If not individual, do old vertical combine:
-        final_img, all_ports = combine_images_vertically(img_ports_list)
-        img_original_size = final_img.size
         draw_ports_flag = False
         if 'ports' in params and (
             params['ports'] == True or
@@ -645,18 +868,47 @@ def handler(event, context):
             or params['ports'].upper() == "YES"):
             draw_ports_flag = True
 
+        scale = get_render_scale(params, img_ports_list)
+        fmt = format_param_get(params)
+        streamed = (stream_png and fmt == 'png' and scale == 1.0 and not draw_ports_flag
+                    and not ('vssx' in params and params['vssx'])
+                    and vertical_layout(img_ports_list)[0][1] <= max_image_height)
+
+        buffered = BytesIO()
+        if streamed:
+            # nothing to draw and no resize, the PNG is written straight
+            # from the components.
+            img_size, all_ports = write_png_vertically(buffered, img_ports_list)
+            final_img = MockImage(img_size, "RGB")
+        elif scale < 1.0:
+            # preview, composed straight at the requested size
+            final_img, all_ports = combine_images_vertically(img_ports_list, scale)
+        elif scaled_compose and not draw_ports_flag:
+            # ports are drawn at full size, so only when there are none
+            scale = fit_scale(vertical_layout(img_ports_list)[0], max_image_height)
+            final_img, all_ports = combine_images_vertically(img_ports_list, scale)
+        else:
+            # If not individual, do old vertical combine:
+            final_img, all_ports = combine_images_vertically(img_ports_list)
+        img_original_size = final_img.size
+
         if all_ports:
             all_ports = sort_ports(all_ports)
 
-        draw_ports_on_image(final_img, all_ports, draw_ports_flag, img_original_size)
+        draw_ports_on_image(final_img, all_ports, draw_ports_flag, img_original_size,
+                            symbol_size=max(1, int(round(16 * scale))))
         final_img = resize_image_and_ports(final_img, all_ports)
 
-        buffered = BytesIO()
-        final_img.save(buffered, format="PNG")
+        encoding = encoders['png']
+        if not streamed:
+            buffered, encoding = encode_image(final_img, fmt, use_s3_size_limit * 1024 * 1024)
         size_of_buffered_in_mib = len(buffered.getvalue()) / ( 1024 * 1024 )
 
         if 'vssx' in params and params['vssx']:
-            name, vssx_buffer = create_vssx_for_image(final_img, all_ports, diagram, params)
+            # the stencil embeds the png that was just encoded, unless a
+            # different format was asked for
+            png_bytes = buffered.getvalue() if fmt == 'png' else None
+            name, vssx_buffer = create_vssx_for_image(final_img, all_ports, diagram, params, png_bytes)
             zip_file_size = len(vssx_buffer.getvalue()) / (1024 * 1024)
             if zip_file_size > use_s3_size_limit:
                 s3_link = upload_to_s3(vssx_buffer, "vssx", "application/vnd.ms-visio.stencil", f'attachment; filename="{name}.vssx"')
@@ -702,12 +954,12 @@ def handler(event, context):
                 )
 
             if size_of_buffered_in_mib > use_s3_size_limit:
-                link = upload_to_s3(buffered, "png", "image/png", 'inline')
+                link = upload_to_s3(buffered, encoding['extension'], encoding['content_type'], 'inline')
                 data["image"] = link
                 data['image_type'] = "link"
             else:
                 data["image"] = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                data['image_type'] = "png"
+                data['image_type'] = encoding['image_type']
 
             json_param = bool_param_get(params, 'json', False)
             if json_param:
@@ -730,7 +982,7 @@ def handler(event, context):
             return create_response(
                 status_code=200,
                 body=data['image'],
-                headers={"Content-Type": "image/png"},
+                headers={"Content-Type": encoding['content_type']},
                 is_base64_encoded=True,
                 params=original_params,
                 diagram=diagram
@@ -8,7 +8,13 @@ default_array_model = 'fa-x20r2'
 
 from purerackdiagram.utils import (
     InvalidConfigurationException,
+    combine_images_vertically,
+    preload,
+    render_scale,
+    vertical_layout,
 )
+from purerackdiagram.canonical import canonical_config, canonical_json
+from purerackdiagram.renderplan import execute_plan, plan_digest
 
 def get_diagram(params):
     model = params.get('model', default_array_model).lower()
@@ -30,6 +36,24 @@ def get_diagram(params):
     return diagram
 
 
+def canonical_params(params):
+    """params in canonical form, the config of the diagram they ask for.
+
+    Requests that draw the same diagram get the same canonical params, params
+    is left as it is.
+    """
+    return canonical_config(get_diagram(dict(params)).config)
+
+
+def render_plan(params):
+    """The render plan of each component of the diagram params ask for, what
+    get_image() would draw without drawing it, see renderplan.
+
+    params is left as it is.
+    """
+    return get_diagram(dict(params)).plan()
+
+
 def get_image_sync(params):
     diagram = get_diagram(params)
     img = asyncio.run(diagram.get_image())
@@ -37,7 +61,10 @@ def get_image_sync(params):
 
 
 def get_image_bytes_png_sync(params):
+    """The diagram as a PNG, scaled down by the scale / max_width params if given"""
     buffered = BytesIO()
-    img = get_image_sync(params)
+    image_ports = get_image_sync(params)
+    scale = render_scale(params, vertical_layout(image_ports)[0])
+    img, _ = combine_images_vertically(image_ports, scale)
     img.save(buffered, format="PNG")
     return buffered
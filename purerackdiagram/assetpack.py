@@ -0,0 +1,158 @@
+"""Pre-decoded asset pack.
+
+Every png under purerackdiagram/png is decoded once at build time and
+written as raw RGBA into a single file with an index in front of it.  At
+runtime the file is memory mapped and each asset is wrapped with
+Image.frombuffer, so nothing is inflated on a cold start and only the pages
+a request actually touches are read from disk.
+
+Build it with:
+
+    python3 update_config.py --asset-pack
+
+The decoded assets are large (roughly 800 MB for the full png directory),
+so the pack is optional.  When it's missing, or an asset in it no longer
+matches its png, RackImage falls back to decoding the png.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from PIL import Image
+
+logger = logging.getLogger()
+
+MAGIC = b'PRDPACK1'
+# magic followed by the length of the json index
+HEADER = struct.Struct('<8sQ')
+PACK_VERSION = 1
+
+root_path = os.path.dirname(__file__)
+default_pack_path = os.path.join(root_path, 'assets.pack')
+
+
+def _png_fingerprint(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return len(data), zlib.crc32(data)
+
+
+def build_pack(png_dir=None, pack_path=None):
+    """Decode every png in png_dir and write them into a pack file"""
+    # imported here, utils opens the pack at import time
+    from .utils import load_asset
+
+    png_dir = png_dir or os.path.join(root_path, 'png')
+    pack_path = pack_path or default_pack_path
+
+    names = sorted(n for n in os.listdir(png_dir) if n.endswith('.png'))
+
+    assets = {}
+    blobs = []
+    offset = 0
+    for name in names:
+        path = os.path.join(png_dir, name)
+        img = load_asset(path)
+        if img.mode != 'RGBA':
+            logger.warning(f"Skipping {name}, decodes to {img.mode} not RGBA")
+            continue
+        data = img.tobytes()
+        png_size, png_crc32 = _png_fingerprint(path)
+        assets[f"png/{name}"] = {
+            'offset': offset,
+            'length': len(data),
+            'size': list(img.size),
+            'png_size': png_size,
+            'png_crc32': png_crc32,
+        }
+        blobs.append(data)
+        # keep every asset page aligned
+        offset += len(data) + (-len(data) % mmap.PAGESIZE)
+
+    index = json.dumps({'version': PACK_VERSION, 'assets': assets}).encode('utf-8')
+    data_start = HEADER.size + len(index)
+    data_start += -data_start % mmap.PAGESIZE
+
+    tmp_path = pack_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(index)))
+        f.write(index)
+        f.write(b'\0' * (data_start - f.tell()))
+        for data in blobs:
+            f.write(data)
+            f.write(b'\0' * (-len(data) % mmap.PAGESIZE))
+    os.replace(tmp_path, pack_path)
+
+    return pack_path, len(assets), os.path.getsize(pack_path)
+
+
+class AssetPack():
+    """Read only view of a pack file built by build_pack"""
+
+    def __init__(self, pack_path, png_root=None):
+        self.pack_path = pack_path
+        self.png_root = png_root or root_path
+        self._file = open(pack_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, index_len = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{pack_path} is not an asset pack")
+        index = json.loads(self._mmap[HEADER.size:HEADER.size + index_len])
+        if index['version'] != PACK_VERSION:
+            raise ValueError(f"{pack_path} is pack version {index['version']}, expected {PACK_VERSION}")
+
+        data_start = HEADER.size + index_len
+        self.data_start = data_start + (-data_start % mmap.PAGESIZE)
+        self.assets = index['assets']
+        self._images = {}
+
+    def __contains__(self, key):
+        return key in self.assets
+
+    def _is_current(self, key, entry):
+        # the png may have been edited since the pack was built
+        path = os.path.join(self.png_root, key)
+        try:
+            png_size, png_crc32 = _png_fingerprint(path)
+        except OSError:
+            return False
+        return png_size == entry['png_size'] and png_crc32 == entry['png_crc32']
+
+    def get(self, key):
+        """Returns a read only RGBA image backed by the pack, or None"""
+        img = self._images.get(key)
+        if img is not None:
+            return img
+
+        entry = self.assets.get(key)
+        if entry is None:
+            return None
+
+        if not self._is_current(key, entry):
+            logger.warning(f"Asset pack entry for {key} is stale, decoding the png instead")
+            self.assets.pop(key, None)
+            return None
+
+        start = self.data_start + entry['offset']
+        buffer = memoryview(self._mmap)[start:start + entry['length']]
+        # zero copy, the image reads straight out of the mapping
+        img = Image.frombuffer('RGBA', tuple(entry['size']), buffer, 'raw', 'RGBA', 0, 1)
+        self._images[key] = img
+        return img
+
+
+def open_pack(pack_path=None):
+    """Open the asset pack if there is one, otherwise returns None"""
+    pack_path = pack_path or os.environ.get('RACKDIAGRAM_ASSET_PACK', default_pack_path)
+    if not os.path.exists(pack_path):
+        return None
+    try:
+        return AssetPack(pack_path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not open asset pack {pack_path}: {e}")
+        return None
+
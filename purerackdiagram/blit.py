@@ -0,0 +1,147 @@
+"""NumPy raster backend for render plans.
+
+execute_plan() in renderplan draws a plan with one Image.paste() per op.
+execute_plan_numpy() draws the same plan into a NumPy array instead.
+Runs of pastes of the same sprite, a row of flash modules or a grid of
+FB-S blades, are written in one strided copy when they sit on a regular
+grid, with everything else a slice copy each.  The pastes in a plan have no
+mask, they replace the pixels underneath, so a batch is a plain copy.  The
+ops that blend (text and the datapack label boxes) are drawn by Pillow
+straight into the same buffer.
+
+The result is a Pillow image over the array, no copy is made to hand it
+back, and the pixels are identical to execute_plan().
+
+NumPy is optional, available is False without it and execute_plan() sticks
+to Pillow.
+"""
+from PIL import Image
+
+from .canonical import canonical_json
+from .renderplan import sprite_image
+from .text import draw_text
+from .utils import RackImage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+available = np is not None
+
+
+def image_view(canvas, writable=False):
+    """A Pillow image over the pixels of canvas, an (h, w, 4) uint8 array"""
+    img = Image.frombuffer("RGBA", (canvas.shape[1], canvas.shape[0]), canvas,
+                           "raw", "RGBA", 0, 1)
+    if writable:
+        # frombuffer images are read only, Pillow would draw on a copy
+        # rather than the array
+        img.readonly = 0
+    return img
+
+
+def _grid(positions, size, canvas_size):
+    """(x0, y0, dx, dy, columns, rows) when positions fill a regular grid of
+    non overlapping sprites of size inside the canvas, else None"""
+    w, h = size
+    xs = sorted({x for x, _ in positions})
+    ys = sorted({y for _, y in positions})
+    if len(xs) * len(ys) != len(positions) or len(set(positions)) != len(positions):
+        return None
+    dx = xs[1] - xs[0] if len(xs) > 1 else w
+    dy = ys[1] - ys[0] if len(ys) > 1 else h
+    if dx < w or dy < h:
+        return None
+    if any(b - a != dx for a, b in zip(xs, xs[1:])) or any(b - a != dy for a, b in zip(ys, ys[1:])):
+        return None
+    if xs[0] < 0 or ys[0] < 0 or xs[-1] + w > canvas_size[0] or ys[-1] + h > canvas_size[1]:
+        return None
+    return xs[0], ys[0], dx, dy, len(xs), len(ys)
+
+
+def _blit_grid(canvas, sprite, grid):
+    x0, y0, dx, dy, columns, rows = grid
+    h, w = sprite.shape[:2]
+    s0, s1, s2 = canvas.strides
+    # every copy of the sprite as one (rows, h, columns, w, 4) view
+    target = np.lib.stride_tricks.as_strided(
+        canvas[y0:, x0:], shape=(rows, h, columns, w, 4),
+        strides=(dy * s0, s0, dx * s1, s1, s2), writeable=True)
+    target[...] = sprite[None, :, None]
+
+
+def _blit(canvas, sprite, xy):
+    # Image.paste() without a mask, clipped to the canvas
+    h, w = sprite.shape[:2]
+    x, y = xy
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + w, canvas.shape[1]), min(y + h, canvas.shape[0])
+    if right > left and bottom > top:
+        canvas[top:bottom, left:right] = sprite[top - y:bottom - y, left - x:right - x]
+
+
+async def _sprite_array(sprite, arrays):
+    key = canonical_json(sprite)
+    if key not in arrays:
+        if sprite[0] == 'plan':
+            arrays[key] = await _execute(sprite[1], arrays)
+        else:
+            img = await sprite_image(sprite)
+            arrays[key] = np.asarray(img if img.mode == "RGBA" else img.convert("RGBA"))
+    return arrays[key]
+
+
+async def _execute(plan, arrays):
+    base = await RackImage(plan['base']).get_sprite()
+    # Pillow copies the base straight into the canvas, np.array(base)
+    # would go through a bytes copy first
+    canvas = np.empty((base.size[1], base.size[0], 4), dtype=np.uint8)
+    view = image_view(canvas, writable=True)
+    view.paste(base if base.mode == "RGBA" else base.convert("RGBA"), (0, 0))
+
+    from .flasharray import apply_dp_label, apply_dp_labelv2
+
+    ops = plan['ops']
+    i = 0
+    while i < len(ops):
+        op = ops[i]
+        if op[0] == 'paste':
+            # the run of pastes of this sprite
+            j = i + 1
+            while j < len(ops) and ops[j][0] == 'paste' and ops[j][1] == op[1]:
+                j += 1
+            sprite = await _sprite_array(op[1], arrays)
+            positions = [tuple(o[2]) for o in ops[i:j]]
+            grid = None
+            if len(positions) > 1:
+                grid = _grid(positions, (sprite.shape[1], sprite.shape[0]),
+                             (canvas.shape[1], canvas.shape[0]))
+            if grid:
+                _blit_grid(canvas, sprite, grid)
+            else:
+                for xy in positions:
+                    _blit(canvas, sprite, xy)
+            i = j
+            continue
+
+        if op[0] == 'text':
+            draw_text(view, tuple(op[1]), op[2], op[3], tuple(op[4]))
+        elif op[0] in ('dp_label_v2', 'dp_label'):
+            label = apply_dp_labelv2 if op[0] == 'dp_label_v2' else apply_dp_label
+            img = label(view, *op[1:])
+            if img is not view:
+                canvas[...] = np.asarray(img.convert("RGBA"))
+        else:
+            raise ValueError(f"Unknown render plan op {op[0]}")
+        i += 1
+    return canvas
+
+
+async def execute_plan_numpy(plan):
+    """Draws the plan into a NumPy array, returns a (read only) Pillow image
+    over it, the same pixels as renderplan.execute_plan()"""
+    if not plan['ops']:
+        # nothing drawn on it, share the cached asset
+        return await RackImage(plan['base']).get_sprite()
+    return image_view(await _execute(plan, {}))
@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+
+def image_nbytes(img):
+    """Approximate number of bytes held by a decoded image"""
+    if not hasattr(img, 'getbands'):
+        # MockImage and friends don't hold any pixel data
+        return 0
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+class LRUCache():
+    """A least recently used cache with a byte budget instead of an entry count.
+
+    Each entry is stored with the number of bytes it is charged against the
+    budget, when a new entry pushes the total over max_bytes the least
+    recently used entries are evicted until it fits again.  Entries larger
+    than the whole budget are not cached at all.
+
+    Counters for hits, misses and evictions are kept so they can be
+    reported, see stats().
+    """
+
+    def __init__(self, max_bytes, name="cache"):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+
+            if nbytes > self.max_bytes:
+                return False
+
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+            return True
+
+    def resize(self, max_bytes):
+        """Change the byte budget, evicting entries if it shrinks"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        # caller must hold the lock
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
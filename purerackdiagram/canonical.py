@@ -0,0 +1,45 @@
+"""Canonical diagram parameters.
+
+The same diagram can be asked for in many spellings, the model in any case,
+defaults left out or passed empty, booleans as "True", "yes" or "1",
+datapacksv2 / bladesv2 as jsonurl, unknown (misspelled) params that are
+ignored.  Rather than a second copy of the defaults in FADiagram,
+FBDiagram and FBSDiagram, the canonical form is the config their __init__
+resolves the params to, which is everything get_image() draws from.
+"""
+import json
+
+# config entries the images only test for truth, "True", "yes" and True
+# all draw the same
+truth_keys = ('fm_label', 'dp_label', 'bezel', 'xfm', 'xfm_show_front')
+
+
+def canonical_value(value):
+    """value with dicts as [key, value] pairs sorted by key and tuples as lists"""
+    if isinstance(value, dict):
+        return sorted(([str(k), canonical_value(v)] for k, v in value.items()),
+                      key=lambda item: item[0])
+    if isinstance(value, (list, tuple)):
+        return [canonical_value(v) for v in value]
+    return value
+
+
+def _truth_resolved(value):
+    # truth_keys as True or False at any depth, the FA shelves carry their
+    # own copies of the labels
+    if isinstance(value, dict):
+        return {k: bool(v) if k in truth_keys else _truth_resolved(v)
+                for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_truth_resolved(v) for v in value]
+    return value
+
+
+def canonical_config(config):
+    """A diagram's config in canonical form, equal for configs that draw the same image"""
+    return canonical_value(_truth_resolved(config))
+
+
+def canonical_json(value):
+    """value as compact json with its keys in order"""
+    return json.dumps(canonical_value(value), separators=(',', ':'), default=str)
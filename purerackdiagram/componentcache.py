@@ -0,0 +1,106 @@
+"""Cache of finished components.
+
+Many different requests share components, the same x70r4 back face with
+different shelves, the same shelf under a different chassis, a run of full
+FB-S chassis.  get_component() keeps each finished component
+({'img', 'ports'}) keyed by the config fields it is drawn from, so a
+request that changes one shelf only draws that shelf.
+
+Drawing a component can also write to the config it was given, the FA
+chassis and shelves add the flash module locations of each datapack to
+the datapack lists that the diagram's config shares with them (they end up
+in the JSON response).  Whatever a component changed in its config is kept
+with it and done again to the config on a hit.
+"""
+import asyncio
+import concurrent.futures
+import copy
+import os
+import threading
+
+from PIL import Image
+
+from .cache import LRUCache, image_nbytes
+from .canonical import canonical_config, canonical_json
+from .utils import read_only_handle
+
+component_cache_mb = int(os.environ.get('RACKDIAGRAM_COMPONENT_CACHE_MB', 128))
+component_cache = LRUCache(component_cache_mb * 1024 * 1024, name="components")
+
+# futures for the keys being drawn, from any thread or event loop
+drawing = {}
+drawing_lock = threading.Lock()
+
+
+def _handed_out(entry):
+    # the image is shared copy on write and the ports are new dicts, so
+    # drawing ports on the result or moving them leaves the cache alone
+    img = entry['img']
+    if isinstance(img, Image.Image):
+        img = read_only_handle(img)
+    return {'img': img, 'ports': [p.copy() for p in entry['ports']]}
+
+
+def _apply_changes(config, changes):
+    for name, value in changes.items():
+        current = config.get(name)
+        value = copy.deepcopy(value)
+        # in place, the diagram's config holds the same list or dict
+        if isinstance(current, list) and isinstance(value, list):
+            current[:] = value
+        elif isinstance(current, dict) and isinstance(value, dict):
+            current.clear()
+            current.update(value)
+        else:
+            config[name] = value
+
+
+async def get_component(kind, fields, draw, config=None):
+    """The component drawn by draw(), from the cache if it has been drawn before.
+
+    kind and fields (the config the drawing depends on) make up the key.
+    draw is an async callable returning {'img', 'ports'}, config the dict
+    it writes to as it draws, if any.  Only writes to the fields are kept.
+
+    Only one draw per key is in flight, identical components in a request
+    (or another thread's request) wait for the first and share its pixels.
+    """
+    key = canonical_json([kind, canonical_config(fields)])
+    with drawing_lock:
+        future = drawing.get(key)
+        entry = component_cache.get(key) if future is None else None
+        owner = future is None and entry is None
+        if owner:
+            future = concurrent.futures.Future()
+            drawing[key] = future
+
+    if not owner:
+        if entry is None:
+            entry = await asyncio.wrap_future(future)
+        if config is not None:
+            _apply_changes(config, entry['changes'])
+        return _handed_out(entry)
+
+    try:
+        # only the fields are watched, other components can be writing to
+        # the rest of the config (the shelves) at the same time
+        before = copy.deepcopy({name: config.get(name) for name in fields}) if config is not None else {}
+        result = await draw()
+        changes = {}
+        for name, value in before.items():
+            if config.get(name) != value:
+                changes[name] = copy.deepcopy(config.get(name))
+
+        entry = {'img': result['img'], 'ports': [p.copy() for p in result['ports']],
+                 'changes': changes}
+        component_cache.put(key, entry, image_nbytes(result['img']))
+        future.set_result(entry)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        # cached before it stops being in flight, so there's no window
+        # where neither has it
+        with drawing_lock:
+            del drawing[key]
+    return _handed_out(entry)
@@ -0,0 +1,66 @@
+"""Precompiled config.yaml.
+
+Parsing config.yaml with the pure python yaml loader is the biggest single
+cost of importing the package, so update_config.py also writes the parsed
+config out as a pickle along with the sha256 of the yaml it came from.
+load_config() uses the pickle when the hash still matches config.yaml and
+falls back to parsing the yaml when it doesn't (config.yaml edited by hand,
+or the pickle missing).
+"""
+import hashlib
+import logging
+import os
+import pickle
+
+logger = logging.getLogger()
+
+root_path = os.path.dirname(__file__)
+default_yaml_path = os.path.join(root_path, 'config.yaml')
+default_compiled_path = os.path.join(root_path, 'config.pickle')
+
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_compiled_config(yaml_path=None, compiled_path=None):
+    """Parse yaml_path and write it out as a pickle with its hash"""
+    yaml_path = yaml_path or default_yaml_path
+    compiled_path = compiled_path or default_compiled_path
+
+    import yaml
+
+    # parse the file that was written rather than pickling the config
+    # update_config built, so the result is exactly what yaml would load.
+    with open(yaml_path, 'r') as f:
+        config = yaml.full_load(f)
+
+    tmp_path = compiled_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'sha256': _sha256(yaml_path), 'config': config}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, compiled_path)
+    return config
+
+
+def load_config(yaml_path=None, compiled_path=None):
+    """Load the config, from the pickle if it's current otherwise the yaml"""
+    yaml_path = yaml_path or default_yaml_path
+    compiled_path = compiled_path or default_compiled_path
+
+    try:
+        with open(compiled_path, 'rb') as f:
+            compiled = pickle.load(f)
+        if compiled['sha256'] == _sha256(yaml_path):
+            return compiled['config']
+        logger.warning(f"{compiled_path} is stale, loading {yaml_path} instead. Run update_config.py")
+    except FileNotFoundError:
+        logger.info(f"No compiled config at {compiled_path}, loading {yaml_path}")
+    except Exception as e:
+        logger.warning(f"Could not load {compiled_path}: {e}")
+
+    # only imported when needed, importing yaml alone costs ~10ms
+    import yaml
+    with open(yaml_path, 'r') as f:
+        return yaml.full_load(f)
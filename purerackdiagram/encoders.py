@@ -0,0 +1,118 @@
+"""Output image encoders.
+
+Everything used to go out as a PNG saved with the default settings, large
+racks then went over the inline response limit and had to be uploaded to
+S3.  encode_image() saves an image in one of the formats below, 'auto'
+tries them in order and keeps the first one under a size limit, lossless
+formats first.
+"""
+from io import BytesIO
+import logging
+import os
+
+from PIL import Image, features
+
+from .pngwriter import write_png_parallel
+from .utils import InvalidConfigurationException
+
+logger = logging.getLogger()
+
+# big PNGs are deflated on all cores when RACKDIAGRAM_PARALLEL_PNG is set,
+# the bytes differ from Pillow's (unfiltered rows) but the pixels don't.
+parallel_png = os.environ.get('RACKDIAGRAM_PARALLEL_PNG', '').lower() in ('1', 'true', 'yes')
+parallel_png_min_pixels = 2 * 1024 * 1024
+# 0-9, -1 is zlib's default (6)
+png_compress_level = int(os.environ.get('RACKDIAGRAM_PNG_LEVEL', -1))
+
+
+def _save_png(img, fp):
+    if parallel_png and img.size[0] * img.size[1] >= parallel_png_min_pixels:
+        write_png_parallel(fp, img, png_compress_level)
+    else:
+        img.save(fp, format="PNG", compress_level=png_compress_level)
+
+
+def _save_png8(img, fp):
+    # fast octree is the only quantizer that does RGBA as well as RGB
+    img.quantize(256, method=Image.Quantize.FASTOCTREE).save(fp, format="PNG")
+
+
+def _save_webp(img, fp):
+    # the lowest effort, still smaller and faster than png.  More effort
+    # only saves another 20% at ten times the time
+    img.save(fp, format="WEBP", lossless=True, quality=0, method=0)
+
+
+def _save_webp_lossy(img, fp):
+    img.save(fp, format="WEBP", quality=85, method=2)
+
+
+def _save_jpeg(img, fp):
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.save(fp, format="JPEG", quality=85)
+
+
+# image_type is what the json response calls it, png8 is still a png
+encoders = {
+    'png': {'image_type': 'png', 'content_type': 'image/png', 'extension': 'png',
+            'feature': None, 'save': _save_png},
+    'webp': {'image_type': 'webp', 'content_type': 'image/webp', 'extension': 'webp',
+             'feature': 'webp', 'save': _save_webp},
+    'png8': {'image_type': 'png', 'content_type': 'image/png', 'extension': 'png',
+             'feature': None, 'save': _save_png8},
+    'webp-lossy': {'image_type': 'webp', 'content_type': 'image/webp', 'extension': 'webp',
+                   'feature': 'webp', 'save': _save_webp_lossy},
+    'jpeg': {'image_type': 'jpeg', 'content_type': 'image/jpeg', 'extension': 'jpg',
+             'feature': 'jpg', 'save': _save_jpeg},
+}
+
+# the order auto tries them in, best quality first
+auto_order = ['png', 'webp', 'png8', 'webp-lossy', 'jpeg']
+
+
+def available_formats():
+    """The format names this Pillow build can write, plus auto"""
+    return [name for name, e in encoders.items()
+            if e['feature'] is None or features.check(e['feature'])] + ['auto']
+
+
+def format_param_get(params, default='png'):
+    """The 'format' param, checked against the available formats"""
+    fmt = str(params.get('format', '')).lower().strip() or default
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt not in available_formats():
+        raise InvalidConfigurationException(
+            f"Invalid value for parameter 'format': '{params['format']}'. Expected one of: {', '.join(available_formats())}")
+    return fmt
+
+
+def encode_image(img, fmt='png', size_limit=None):
+    """Saves img as fmt, returns the buffer and the encoders entry used.
+
+    For 'auto' the first format in auto_order that comes in at or under
+    size_limit bytes is used, or the smallest if none of them do.
+    """
+    if fmt != 'auto':
+        buffered = BytesIO()
+        encoders[fmt]['save'](img, buffered)
+        return buffered, encoders[fmt]
+
+    smallest = None
+    for name in auto_order:
+        if name not in available_formats():
+            continue
+        buffered = BytesIO()
+        try:
+            encoders[name]['save'](img, buffered)
+        except (OSError, ValueError) as e:
+            # webp can't do images over 16383 pixels on a side
+            logger.info(f"Could not encode as {name}: {e}")
+            continue
+        size = buffered.getbuffer().nbytes
+        if size_limit is None or size <= size_limit:
+            return buffered, encoders[name]
+        if smallest is None or size < smallest[0].getbuffer().nbytes:
+            smallest = (buffered, encoders[name])
+    return smallest
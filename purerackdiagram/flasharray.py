@@ -6,11 +6,15 @@ import asyncio
 
 from PIL import Image
 from PIL import ImageDraw
-from PIL import ImageFont
 # from io import BytesIO
 
 from . import utils
 from .utils import RackImage, add_ports_at_offset, InvalidConfigurationException, InvalidDatapackException, bool_param_get
+from .renderplan import (new_plan, asset_sprite, fm_sprite, paste_op, text_op,
+                         apply_config_updates, plan_layout, execute_plan)
+from .text import draw_text, text_bbox, text_box
+from .cache import LRUCache, image_nbytes
+from .componentcache import get_component
 
 import jsonurl_py as jsonurl
 
@@ -25,159 +29,66 @@ class FAShelf():
     def __init__(self, params):
         self.config = params
         self.json_only = bool_param_get(params,'json_only', False)
-        self.start_img_event = asyncio.Event()
-        self.ports = []
 
     # Called externally to retrieve the image of the shelf
     async def get_image(self):
-        c = self.config
-        tasks = []
-        tasks.append(self.get_base_img())
-        if c["face"] == "front":
-            if c["shelf_type"] == "nvme":
-                tasks.append(self.add_nvme_fms())
-            else:
-                tasks.append(self.add_sas_fms())
-        else:
-            tasks.append(self.add_power())
-
-        # load the base image and FMs simultaniously.
-        await asyncio.gather(*tasks)
-        return {'img':self.tmp_img, 'ports': self.ports}
-
-    # load the first base image
-    async def get_base_img(self):
+        plan = self.plan()
+        apply_config_updates(self.config, plan)
+        img = await execute_plan(plan, self.json_only)
+        return {'img': img, 'ports': plan['ports']}
+
+    def layout(self):
+        """The size and ports of the shelf, what get_image() returns in
+        json_only mode, from its plan without drawing anything"""
+        plan = self.plan()
+        apply_config_updates(self.config, plan)
+        return plan_layout(plan)
+
+    def plan(self):
+        """The render plan of the shelf, see renderplan"""
         c = self.config
         key = "png/pure_fa_{}_shelf_{}.png".format(c["shelf_type"], c["face"])
-
-        self.tmp_img = await RackImage(key, self.json_only).get_image()
+        plan = new_plan(key)
 
         # Load image info
-        self.img_info = {}
+        img_info = {}
         if key in utils.global_config:
-            self.img_info = utils.global_config[key]
+            img_info = utils.global_config[key]
 
-        if 'ports' in self.img_info:
-            self.ports = self.img_info['ports']
+        # new dicts, the ports get names and symbols added later on
+        add_ports_at_offset(key, (0, 0), plan['ports'])
 
-        self.start_img_event.set()
-
-    async def add_power(self):
+        if c["face"] == "front":
+            if c["shelf_type"] == "nvme":
+                self.plan_nvme_fms(plan, img_info)
+            else:
+                self.plan_sas_fms(plan, img_info)
+        else:
+            self.plan_power(plan, img_info)
+        return plan
 
+    def plan_power(self, plan, img_info):
         if self.config.get('dc_power', False):
+            dc_power = asset_sprite("png/pure_fa_dc_1300.png")
+            plan['ops'].append(paste_op(dc_power, img_info['psu_loc'][0]))
+            plan['ops'].append(paste_op(dc_power, img_info['psu_loc'][1]))
 
-            key = "png/pure_fa_dc_1300.png"
-
-            dc_power_img = await RackImage(key, self.json_only).get_image()
-            await self.start_img_event.wait()
-            self.tmp_img.paste(dc_power_img, self.img_info['psu_loc'][0])
-            self.tmp_img.paste(dc_power_img, self.img_info['psu_loc'][1])
-
-    async def add_nvme_fms(self):
-        cur_module = 0
-         # wait until the base image is loaded
-        await self.start_img_event.wait()
-
-        fm_loc = self.img_info['fm_loc']
-
-        total_fm_count = 28
-        rotate_after = 19 
-
-        for dp in self.config["datapacks"]:
-            dpv2_start_index = -1
-
-            if len(dp) > 4:
-                # we are storing values in a list which should be a dictionary
-                # as each index corresponds to a different value.
-                # however, we are re-using it to pass fm loc, so we need to pull out this extra value
-                # and then remove it from the list so it doesn't break the rest of the code.
-                dpv2_start_index = dp[4]
-                del dp[4]
-
-            
-
-            fm_str = dp[0]
-            fm_type = dp[1]
-            img_name = 'png/pure_fa_fm_{}.png'.format(fm_type)
-            num_modules = dp[2]
-
-            if fm_str == 'Blank':
-                num_modules = 14
-
-            fm_img = await RackImage(img_name, self.json_only).get_image()
-
-            if self.config['fm_label']:
-                apply_fm_label(fm_img, fm_str, fm_type)
-
-           
-            fm_rotated = fm_img.rotate(-90, expand=True)
-            
-            
-            first_fm = True
-            the_range = list(range(cur_module, min(28, num_modules + cur_module)))
-            cur_module += num_modules
-            # curr_modules keeps track of next free location
-            # however with dpv2 they can pass in their own.
-            if dpv2_start_index != -1:
-                the_range = list(range(dpv2_start_index, dpv2_start_index + num_modules))
-                cur_module = dpv2_start_index + num_modules
-            for x in the_range:
-                if x >= total_fm_count:
-                    raise InvalidConfigurationException(
-                        f"Too many fm modules, check data pack sizes dont exceed chassis size of {total_fm_count}" )
-                
-                if first_fm:
-                    dp.append(fm_loc[x])
-                    dp.append(fm_loc[x])
-                    dp.append(x > rotate_after) # rotate after
-                    first_fm = False
-                
-                if len(dp) == 7: #Length of 7 means we have a continious DP so far,
-                    if fm_loc[x][0] >= dp[5][0] :
-                        # The x is to the right, so just update the current DP range with new furthest FM loc
-                        dp[5] = fm_loc[x]
-                    else:
-                        # We are starting a new range because the x is to the left,
-                        # these will be in location dp[6] and dp[7]
-                        dp.append(fm_loc[x])
-                        dp.append(fm_loc[the_range[-1]])
-                        dp.append(x > rotate_after) # rotate after
-
-                if x <= rotate_after:
-                    self.tmp_img.paste(fm_img, fm_loc[x])
-                else:
-                    self.tmp_img.paste(fm_rotated, fm_loc[x])
-                
+    def plan_nvme_fms(self, plan, img_info):
+        fm_loc = img_info['fm_loc']
+        datapacks, rotate_after, placements = place_shelf_nvme_fms(self.config, fm_loc)
+        plan['config_updates']['datapacks'] = datapacks
 
+        for dp_i, x in placements:
+            dp = datapacks[dp_i]
+            img_name = 'png/pure_fa_fm_{}.png'.format(dp[1])
+            fm = fm_sprite(img_name, dp[0], dp[1], self.config['fm_label'], rotated=x > rotate_after)
+            plan['ops'].append(paste_op(fm, fm_loc[x]))
 
         # add datapack labels
         if self.config['dp_label']:
-            for dp in self.config["datapacks"]:
-                dp_size = dp[3]
-                
-                if len(dp) > 4:
-                    start_loc = dp[4]
-                    end_loc = dp[5]
-                    rotate = dp[6]
-                    if dp_size.replace('.', '', 1).isdigit():
-                        text = str(dp_size) + "TB"
-                    else:
-                        text = dp_size
-                
-                    self.tmp_img = apply_dp_labelv2(self.tmp_img, text, start_loc, end_loc, rotate)
-
-                # if it's a continue DP then add the second section.
-                if len(dp) > 7:
-                    start_loc = dp[7]
-                    end_loc = dp[8]
-                    rotate = dp[9]
-                    text = "..Continued"
-
-                    # use the new apply_dp_label
-                    self.tmp_img = apply_dp_labelv2(self.tmp_img, text , start_loc, end_loc, rotate)
-
+            plan_dp_labels(plan, datapacks)
 
-    async def add_sas_fms(self):
+    def plan_sas_fms(self, plan, img_info):
         cur_module = 0
         for dp in self.config["datapacks"]:
             fm_str = dp[0]
@@ -185,18 +96,13 @@ class FAShelf():
             num_modules = dp[2]
             if fm_type == 'blank':
                 num_modules = 12
-            dp_size = dp[3]
             fm_img_str = "png/pure_fa_fm_{}.png".format(fm_type)
-            fm_img = await RackImage(fm_img_str, self.json_only).get_image()
+            fm = fm_sprite(fm_img_str, fm_str, fm_type, self.config['fm_label'])
 
-            if self.config['fm_label']:
-                apply_fm_label(fm_img, fm_str, fm_type)
-
-            await self.start_img_event.wait()
-            fm_loc = self.img_info['fm_loc']
+            fm_loc = img_info['fm_loc']
 
             for x in range(cur_module, min(24, cur_module + num_modules)):
-                self.tmp_img.paste(fm_img, fm_loc[x])
+                plan['ops'].append(paste_op(fm, fm_loc[x]))
 
             cur_module += num_modules
 
@@ -204,8 +110,6 @@ class FAShelf():
         right = False
         if self.config['dp_label']:
             for dp in self.config["datapacks"]:
-                fm_str = dp[0]
-                fm_type = dp[1]
                 num_modules = dp[2]
                 dp_size = dp[3]
 
@@ -215,17 +119,23 @@ class FAShelf():
                 if num_modules == 24:
                     full = True
 
-                self.tmp_img = apply_dp_label(self.tmp_img,
-                                              dp_size,
-                                              x_offset,
-                                              y_offset,
-                                              right,
-                                              full)
+                plan['ops'].append(['dp_label', dp_size, x_offset, y_offset, right, full])
                 #right = True
 
 
 # takes the config parsed in FA Diagram and creates the image for the chassis
 class FAChassis():
+    # the config each face is drawn from, the key in the component cache
+    cache_fields = ('json_only', 'face', 'generation', 'release', 'rev', 'model_num')
+    front_cache_fields = ('bezel', 'chassis_gen', 'chassis_datapacks', 'fm_label', 'dp_label')
+    back_cache_fields = ('pci_config', 'default_pci_config', 'mezz', 'dc_power')
+
+    @classmethod
+    def cache_key_fields(cls, config):
+        """The part of config the chassis image depends on"""
+        names = cls.cache_fields + (cls.front_cache_fields if config['face'] == 'front'
+                                    else cls.back_cache_fields)
+        return {name: config.get(name) for name in names}
 
     def __init__(self, params):
         config = params.copy()
@@ -233,150 +143,47 @@ class FAChassis():
             del config["shelves"]
         self.config = config
         self.json_only = config.get('json_only', False)
-        self.start_img_event = asyncio.Event()
-        self.ch0_fm_loc = None
-        self.ports = []
-        self.lock = asyncio.Lock()
-
-
-
 
     async def get_image(self):
-        # build the image
+        plan = self.plan()
+        apply_config_updates(self.config, plan)
+        img = await execute_plan(plan, self.json_only)
+        return {'img': img, 'ports': plan['ports']}
+
+    def layout(self):
+        """The size and ports of the chassis, what get_image() returns in
+        json_only mode, from its plan without drawing anything"""
+        plan = self.plan()
+        apply_config_updates(self.config, plan)
+        return plan_layout(plan)
+
+    def plan(self):
+        """The render plan of the chassis, see renderplan"""
         c = self.config
-        key = f"png/pure_fa_{c['generation']}_r{c['release']}{c['rev']}"
-        
-
-
-        chassis_gen = ""
-        if c["face"] == "front":
-            if  c["bezel"]:
-                key += "_bezel.png"
-                img =  await RackImage(key, self.json_only).get_image()
-                return {'img': img, 'ports': []}
-            
-            if c['release'] in [1] and c['generation'] in ['c', 'e'] or (
-                c['release'] >= 4 and c['generation'] in ['x', 'c']
-            ):
-                # check for the next generation chassis
-                if c['chassis_gen'] == '2':
-                    chassis_gen = "_cg2"
-
-        # not doing bezel
-        key += f"_{c['face']}{chassis_gen}.png"
-
-        
-
-        tasks = []
-        tasks.append(self.get_base_img(key))
-
-        if key in utils.global_config:
-            self.img_info = utils.global_config[key]
-
-        add_ports_at_offset(key, (0, 0), self.ports)
+        key, bezel = chassis_key(c)
+        plan = new_plan(key)
+        if bezel:
+            return plan
 
+        img_info = utils.global_config[key]
+        add_ports_at_offset(key, (0, 0), plan['ports'])
 
         if c["face"] == "front":
-            tasks.append(self.add_fms())
-            tasks.append(self.add_nvram())
-            tasks.append(self.add_model_text())
+            self.plan_fms(plan, img_info)
+            self.plan_nvram(plan, img_info)
+            self.plan_model_text(plan, img_info)
         else:
-            tasks.append(self.add_cards())
-            tasks.append(self.add_mezz())
-            tasks.append(self.add_power())
-
-        # run all the tasks concurrently
-        await asyncio.gather(*tasks)
+            # the mezz ports are added before the cards
+            self.plan_mezz(plan, img_info)
+            self.plan_cards(plan, img_info)
+            self.plan_power(plan, img_info)
 
         # add port names, has to be done in order so must
-        # be after all the tasks are done.
-
-        # add a thread lock here:
-
-        async with self.lock:
-            await self.add_port_names()
-
-        return {'img': self.tmp_img, 'ports': self.ports}
-    
-    # Add port names to each port if it's missing i.e. ct0.eth7
-    async def add_port_names(self):
-        
-        # add port names
-        # find all on board ports first
-        # select all ports that don't have a pci_slot key
-
-        # add a thread safety lock
-      
+        # be after all the ports are added.
+        name_ports(c, plan['ports'])
+        return plan
 
-
-        
-              
-        port_naming_key = None
-        if self.config['generation'] == 'xl':
-            port_naming_key = 'port_naming_xl'
-        elif self.config['generation'] == 'e':
-            port_naming_key = 'port_naming_xcr4'
-        elif self.config['generation'] in ['x', 'c', 'rc'] :
-            if self.config['release'] >= 4:
-                port_naming_key = 'port_naming_xcr4'
-            else:
-                port_naming_key = 'port_naming_xcr2'
-        
-        if port_naming_key:
-            port_naming = utils.global_config[port_naming_key]
-        else:
-            return
-        
-        prev_ctslotmezz = None
-        p_i = 0
-            
-        for port in self.ports:
-            if 'name' in port:
-                continue # it already has a name so skip
-
-            if 'port_type' in port and 'controller' in port:
-                port_type = port['port_type']
-                if port_type == 'eth_roce':
-                    port_type = 'eth'
-                
-                # because we don't have an indication on when we switch to the next card we need to 
-                # use this slightly messy approach.
-                    
-                if 'pci_slot' in port:
-                    if prev_ctslotmezz != (port['controller'] + str(port['pci_slot'])):
-                        p_i = port_naming[port['pci_slot']][port_type]
-                        prev_ctslotmezz = port['controller'] + str(port['pci_slot'])
-                elif 'mezz' in port:
-                    if prev_ctslotmezz != (port['controller'] + 'mezz'):
-                        p_i = port_naming['mezz'][port_type]
-                        prev_ctslotmezz = port['controller'] + 'mezz'
-                else:
-                    continue
-
-
-                # special case the management port on the xcr4
-                # if port_naming_key == 'port_naming_xcr4' and port['pci_slot'] == 0:
-                #    if port['pci_card'] == 'mgmt2ethbaset' and p_i == 6:
-                #        p_i = 5
-                #    elif port['pci_card'] == 'mgmt2ethbaset' and p_i == 5:
-                #        p_i = 7
-
-                # Add the name to the port
-                # special case the management port in slot 0
-                if port_naming_key == 'port_naming_xcr4' and port['pci_slot'] == 0 \
-                          and port['pci_card'] == 'mgmt2ethbaset' and p_i == 6:
-                    port['name'] = f"{port['controller']}.{port_type}5"
-                else:
-                    port['name'] = f"{port['controller']}.{port_type}{p_i}"
-                # Increment the counter
-                p_i += 1
-
-
-    async def get_base_img(self, key):
-        self.tmp_img = await RackImage(key, self.json_only).get_image()
-        self.start_img_event.set()
-
-    async def add_power(self):
+    def plan_power(self, plan, img_info):
         if self.config['generation'] == 'xl':
             return
 
@@ -391,326 +198,80 @@ class FAChassis():
             else:
                 key = f"png/pure_fa_dc_{self.config['dc_power']}.png"
 
-            dc_power_img = await RackImage(key, self.json_only).get_image()
-            await self.start_img_event.wait()
-            if 'psu_loc' in self.img_info:
-                self.tmp_img.paste(dc_power_img, self.img_info['psu_loc'][0])
-                self.tmp_img.paste(dc_power_img, self.img_info['psu_loc'][1])
-        
-
-    async def add_nvram(self):
-        #base image already has 1 NVRAM populated, so this is only for the second one.
-        if self.config['chassis_gen'] == '2':
-            #gen 2 chassis don't use nvrams
-            return
+            if 'psu_loc' in img_info:
+                plan['ops'].append(paste_op(asset_sprite(key), img_info['psu_loc'][0]))
+                plan['ops'].append(paste_op(asset_sprite(key), img_info['psu_loc'][1]))
 
-        if self.config['generation'] == 'c':
-            # always add second nvram on 'c' array
-            if self.config["model_num"] < 60:
-                # Don't add second nvram on c40 or c50
-                return
-            # C60 & c70 do have 4 nvrams
-            pass
-        elif  self.config['generation'] == 'e':
-            # e uses distrubted NVRAM, so todo:
-            # Need to change the base image in order to remove
-            # and then re-add NVRams.... or add a blank to cover
-            # the base image.
-            return
-        elif self.config['generation'] == 'xl':
-            return
-        elif self.config["model_num"] < 70:
-            # Don't add second nvram on less  than 70
+    def plan_nvram(self, plan, img_info):
+        if not second_nvram(self.config):
             return
-        
-
-        nvram_img = await RackImage("png/pure_fa_x_nvram.png", self.json_only).get_image()
 
-        await self.start_img_event.wait()
-        self.tmp_img.paste(nvram_img, self.img_info['nvram_loc'][0])
-        self.tmp_img.paste(nvram_img, self.img_info['nvram_loc'][1])
+        nvram = asset_sprite("png/pure_fa_x_nvram.png")
+        plan['ops'].append(paste_op(nvram, img_info['nvram_loc'][0]))
+        plan['ops'].append(paste_op(nvram, img_info['nvram_loc'][1]))
 
-    async def add_cards(self):
+    def plan_cards(self, plan, img_info):
         pci = self.config["pci_config"]
-
-        tasks = []
         for x in range(len(pci)):
             if pci[x]:
-                tasks.append(self.add_card(x, pci[x]))
-        await asyncio.gather(*tasks)
-
-    async def add_card(self, slot, card_type):
-        # todo: add this model specific info to the config.yaml
-
-        if self.config['generation'] == 'e':
-            if slot in [1,2]:
-                height = "fh"
-            else:
-                height = "hh"
-
-        elif self.config['generation'] == 'xl':
-            if slot in [2, 3]:
-                height = "fh"
-            else:
-                height = "hh"
-        elif (self.config['generation'] == 'c' or self.config['generation'] == 'x') and self.config['release'] >= 4:
-
-            if slot in [1, 2]:
-                height = "fh"
-            else:
-                height = "hh"
-        else:
-            if slot < 2:
-                height = "fh"
-            else:
-                height = "hh"
+                self.plan_card(plan, img_info, x, pci[x])
 
+    def plan_card(self, plan, img_info, slot, card_type):
+        height = pci_card_height(self.config, slot)
         key = "png/pure_fa_{}_{}.png".format(card_type, height)
+        card = asset_sprite(key)
 
-        card_img = await RackImage(key, self.json_only).get_image()
-        await self.start_img_event.wait() # why is this here ?
-
-        # check to see if this is the default card in this slot
-
-        card_is_default = False
-        if self.config['default_pci_config'][slot] == card_type:
-            card_is_default = True
-        
-        height_str = "Full Height"
-        if height == "hh":
-            height_str = "Half Height"
-        
-        #Get port name
-        
-
-        additional_keys  = {'pci_slot': slot,
-                            'pci_slot_height': height_str, 
-                            'pci_card': card_type,
-                            'default_card': card_is_default,
-                            'controller': "ct0" }
+        additional_keys = pci_card_ports_keys(self.config, slot, card_type, height)
         # ct0
         try:
-            cord = self.img_info['ct0_pci_loc'][slot]
+            cord = img_info['ct0_pci_loc'][slot]
         except KeyError:
             print("KeyError: ct0_pci_loc for slot {}".format(slot))
             raise InvalidConfigurationException(
                 f"Invalid configuration for slot {slot}, check your config.yaml file.")
-        self.tmp_img.paste(card_img, cord)
-        add_ports_at_offset(key, cord, self.ports, additional_keys.copy())
+        plan['ops'].append(paste_op(card, cord))
+        add_ports_at_offset(key, cord, plan['ports'], additional_keys.copy())
 
         # ct1
-        cord = self.img_info['ct1_pci_loc'][slot]
+        cord = img_info['ct1_pci_loc'][slot]
         additional_keys['controller'] = "ct1"
-        add_ports_at_offset(key, cord, self.ports, additional_keys.copy())
-        self.tmp_img.paste(card_img, cord)
+        add_ports_at_offset(key, cord, plan['ports'], additional_keys.copy())
+        plan['ops'].append(paste_op(card, cord))
 
-    async def add_mezz(self):
-        if self.config["generation"] == "xl":
-            return
-        
-        if self.config["release"] >= 4:
-            return
-    
-        if self.config["generation"] == 'e':
-            return
-        
-        if self.config["release"] == 3 and \
-            self.config["model_num"] == 20 and \
-            self.config["generation"] == 'rc':
-            return
-
-        if self.config['mezz']:
-            key = "png/pure_fa_x_{}.png".format(self.config["mezz"])
-            mezz_img = await RackImage(key, self.json_only).get_image()
-            await self.start_img_event.wait()
-
-            self.tmp_img.paste(mezz_img, self.img_info['ct0_mezz_loc'])
-            add_ports_at_offset(key, self.img_info['ct0_mezz_loc'], self.ports)
-
-            self.tmp_img.paste(mezz_img, self.img_info['ct1_mezz_loc'])
-            add_ports_at_offset(key, self.img_info['ct1_mezz_loc'], self.ports)
-
-
-    async def add_fms(self):
-        # is  this the right side data pack ?
-        # starts with no, then we change to yes if it's the last datapack.
-        right = False
-        slots = {}
-
-        # of chassis slots
-        await self.start_img_event.wait()
-
-        # todo add these details into the config.yaml
-        total_fm_count = 20
-        rotate_after = 1000 # i.e. no rotation
-
-        if self.config['generation'] == 'xl':
-            total_fm_count = 40
-            rotate_after = 40 #i.e. no rotation
-        
-        elif self.config['chassis_gen'] == '2':
-            total_fm_count = 28
-            rotate_after = 19
-        
-
-        current_index = 0
-        dp_count = len(self.config["chassis_datapacks"])
-        fm_loc = self.img_info['fm_loc']
-
-        for dp_i in range(dp_count):
-            dp = self.config["chassis_datapacks"][dp_i]
-            dpv2_start_index = -1
-
-            if len(dp) > 4:
-                # we are storing values in a list which should be a dictionary
-                # as each index corresponds to a different value.
-                # however, we are re-using it to pass fm loc, so we need to pull out this extra value
-                # and then remove it from the list so it doesn't break the rest of the code.
-                dpv2_start_index = dp[4]
-                del dp[4]
-
-            # see if this is the last data pack or not
-            if dp_i > 0 and dp_i + 1 == dp_count:
-                # If it's m or X need to populated the 
-                # last datapack from the right side
-
-                # new 8/22/2025 only populate from the right if we have scm in slot 0
-                if self.config['generation'] != 'xl' and self.config['generation'] != 'c' and slots[0] == 'scm':
-                    right = True
+    def plan_mezz(self, plan, img_info):
+        key = mezz_key(self.config)
+        if key:
+            plan['ops'].append(paste_op(asset_sprite(key), img_info['ct0_mezz_loc']))
+            add_ports_at_offset(key, img_info['ct0_mezz_loc'], plan['ports'])
 
-            fm_str = dp[0]
-            fm_type = dp[1]
-            num_modules = dp[2]
-            dp_size = dp[3]
+            plan['ops'].append(paste_op(asset_sprite(key), img_info['ct1_mezz_loc']))
+            add_ports_at_offset(key, img_info['ct1_mezz_loc'], plan['ports'])
 
-            file_name = "png/pure_fa_fm_{}.png".format(fm_type)
-            fm_img = await RackImage(file_name, self.json_only).get_image()
-            
+    def plan_fms(self, plan, img_info):
+        fm_loc = img_info['fm_loc']
+        datapacks, total_fm_count, rotate_after, placements, slots = place_chassis_fms(self.config, fm_loc)
+        plan['config_updates']['chassis_datapacks'] = datapacks
 
-            if self.config['fm_label']:
-                apply_fm_label(fm_img, fm_str, fm_type)
-  
+        for dp_i, x in placements:
+            dp = datapacks[dp_i]
+            file_name = "png/pure_fa_fm_{}.png".format(dp[1])
+            fm = fm_sprite(file_name, dp[0], dp[1], self.config['fm_label'], rotated=x > rotate_after)
+            plan['ops'].append(paste_op(fm, fm_loc[x]))
 
-            await self.start_img_event.wait()
-            if not right:
-                the_range = list(range(current_index, current_index + num_modules))
-                current_index += num_modules
-            else:
-                the_range = list(range(total_fm_count-num_modules, total_fm_count))
-            
-            #dp version2
-            if dpv2_start_index != -1:
-                the_range = list(range(dpv2_start_index, dpv2_start_index + num_modules))
-                current_index = the_range[-1] + 1
-            
-            first_fm = True # used store the first fm location
-            for x in the_range:
-                if x >= total_fm_count:
-                    raise InvalidConfigurationException(
-                        f"Too many fm modules, check data pack sizes dont exceed chassis size of {total_fm_count}" )
-                if first_fm:
-                    dp.append(fm_loc[x]) # dp[4] is the start location of the DP
-                    dp.append(fm_loc[x]) # dp[5] is the end, but we just put this as initial, it will be updated later
-                    dp.append(x > rotate_after) # rotate after
-                    
-                        
-                    first_fm = False
-                
-                if len(dp) == 7: #Length of 7 means we have a continious DP so far, 
-                    if fm_loc[x][0] >= dp[5][0] :
-                        # The x is to the right, so just update the current DP range with new furthest FM loc
-                        dp[5] = fm_loc[x]
-                    else:
-                        # We are starting a new range because the x is to the left,
-                        # these will be in location dp[6] and dp[7]
-                        dp.append(fm_loc[x])
-                        dp.append(fm_loc[the_range[-1]])
-                        dp.append(x > rotate_after) # rotate after
-
-                # self.tmp_img.save("tmp.png")
-                #if not right and x >= num_modules and self.config["generation"] != 'xl':
-                #    # for short DMM modules, fill the rest with blanks
-                #    self.tmp_img.paste(blank_img, fm_loc[x])
-                #else:
-                fm_rotated = fm_img.rotate(-90, expand=True)
-
-                if x in slots and slots[x] != "blank":
-                    if fm_type == "blank":
-                        pass
-                    else:
-                        raise InvalidConfigurationException(
-                            f"Overlapping datapacks, check data pack sizes dont exceed chassis size of {total_fm_count}")
-                else:
-                    # check to make sure index is not out of range:
-                    if x >= len(fm_loc):
-                        raise InvalidConfigurationException(
-                            f"Too many fm modules, check data pack sizes dont exceed chassis size of {total_fm_count}" )
-                    
-                    if x > rotate_after:
-                        self.tmp_img.paste(fm_rotated, fm_loc[x])
-                    else:
-                        self.tmp_img.paste(fm_img, fm_loc[x])
-                    # keep track of modules, to detect overlaps
-                    slots[x] = fm_type
-        
         # add blanks to slots without
-        blank_img = await RackImage("png/pure_fa_fm_blank.png", self.json_only).get_image()
         if self.config['fm_label']:
-            apply_fm_label(blank_img, "Blank", "")
-    
+            blank_key = "png/pure_fa_fm_blank.png"
             for x in range(total_fm_count):
                 if x not in slots:
-                    if x > rotate_after:
-                        self.tmp_img.paste(blank_img.rotate(-90, expand=True), fm_loc[x])
-                    else:
-                        self.tmp_img.paste(blank_img, fm_loc[x])
-                
-        
+                    blank = fm_sprite(blank_key, "Blank", "", rotated=x > rotate_after)
+                    plan['ops'].append(paste_op(blank, fm_loc[x]))
 
-        
         if self.config['dp_label']:
-            right = False
-            for dp in self.config["chassis_datapacks"]:
-                fm_str = dp[0]
-                fm_type = dp[1]
-                num_modules = dp[2]
-                dp_size = dp[3]
-                
-
-                # just checks the dp info has the start_loc and end_loc
-                if len(dp) > 4:
-                    start_loc = dp[4]
-                    end_loc = dp[5]
-                    rotate = dp[6]
-                    if dp_size.replace('.', '', 1).isdigit():
-                        text = str(dp_size) + "TB"
-                    else:
-                        text = dp_size
-
-                    self.tmp_img = apply_dp_labelv2(self.tmp_img, text , start_loc, end_loc, rotate)
-
-                # if it's a continue DP then add the second section.
-                if len(dp) > 7:
-                    start_loc = dp[7]
-                    end_loc = dp[8]
-                    rotate = dp[9]
-                    text = "..Continued"
+            plan_dp_labels(plan, datapacks)
 
-                    # use the new apply_dp_label
-                    self.tmp_img = apply_dp_labelv2(self.tmp_img, text , start_loc, end_loc, rotate)
-    
-                       
-
-    async def add_model_text(self):
-        global ttf_path
-
-        loc = self.img_info['model_text_loc']
-
-        await self.start_img_event.wait()
+    def plan_model_text(self, plan, img_info):
+        loc = img_info['model_text_loc']
         c = self.config
-        draw = ImageDraw.Draw(self.tmp_img)
-
-        font = ImageFont.truetype(ttf_path, size=24)
 
         text = ""
         if c['generation'] == 'xl' :
@@ -732,9 +293,398 @@ class FAChassis():
 
         if c['chassis_gen'] == '2':
             #Draw the Generation Letter on the 2nd gen chassis
-            draw.text((2785,160), f" {c['generation'].upper()} ", (255, 255, 255, 220), font=font)
+            plan['ops'].append(text_op((2785,160), f" {c['generation'].upper()} ", 24, (255, 255, 255, 220)))
         
-        draw.text(loc, text, (255, 255, 255, 220), font=font)
+        plan['ops'].append(text_op(loc, text, 24, (255, 255, 255, 220)))
+
+
+def plan_dp_labels(plan, datapacks):
+    """Adds the labels of datapacks that have their module locations"""
+    for dp in datapacks:
+        dp_size = dp[3]
+
+        # just checks the dp info has the start_loc and end_loc
+        if len(dp) > 4:
+            start_loc = dp[4]
+            end_loc = dp[5]
+            rotate = dp[6]
+            text = dp_label_text(dp_size)
+
+            plan['ops'].append(['dp_label_v2', text, start_loc, end_loc, rotate])
+
+        # if it's a continue DP then add the second section.
+        if len(dp) > 7:
+            start_loc = dp[7]
+            end_loc = dp[8]
+            rotate = dp[9]
+            text = "..Continued"
+
+            # use the new apply_dp_label
+            plan['ops'].append(['dp_label_v2', text, start_loc, end_loc, rotate])
+
+
+def pci_card_height(config, slot):
+    """'fh' or 'hh', the height of the pci slot"""
+    # todo: add this model specific info to the config.yaml
+
+    if config['generation'] == 'e':
+        if slot in [1,2]:
+            height = "fh"
+        else:
+            height = "hh"
+
+    elif config['generation'] == 'xl':
+        if slot in [2, 3]:
+            height = "fh"
+        else:
+            height = "hh"
+    elif (config['generation'] == 'c' or config['generation'] == 'x') and config['release'] >= 4:
+
+        if slot in [1, 2]:
+            height = "fh"
+        else:
+            height = "hh"
+    else:
+        if slot < 2:
+            height = "fh"
+        else:
+            height = "hh"
+    return height
+
+
+def pci_card_ports_keys(config, slot, card_type, height):
+    """The keys added to each port of the card in slot, for ct0"""
+    # check to see if this is the default card in this slot
+    card_is_default = False
+    if config['default_pci_config'][slot] == card_type:
+        card_is_default = True
+
+    height_str = "Full Height"
+    if height == "hh":
+        height_str = "Half Height"
+
+    return {'pci_slot': slot,
+            'pci_slot_height': height_str,
+            'pci_card': card_type,
+            'default_card': card_is_default,
+            'controller': "ct0" }
+
+
+def mezz_key(config):
+    """The image key of the mezzanine card, None when there isn't one"""
+    if config["generation"] == "xl":
+        return None
+
+    if config["release"] >= 4:
+        return None
+
+    if config["generation"] == 'e':
+        return None
+
+    if config["release"] == 3 and \
+        config["model_num"] == 20 and \
+        config["generation"] == 'rc':
+        return None
+
+    if config['mezz']:
+        return "png/pure_fa_x_{}.png".format(config["mezz"])
+    return None
+
+
+def name_ports(config, ports):
+    """Names the controller ports that don't have a name yet, i.e. ct0.eth7.
+
+    Ports are numbered in order within each card or mezz, so ports must be
+    in the order they were added.
+    """
+    port_naming_key = None
+    if config['generation'] == 'xl':
+        port_naming_key = 'port_naming_xl'
+    elif config['generation'] == 'e':
+        port_naming_key = 'port_naming_xcr4'
+    elif config['generation'] in ['x', 'c', 'rc'] :
+        if config['release'] >= 4:
+            port_naming_key = 'port_naming_xcr4'
+        else:
+            port_naming_key = 'port_naming_xcr2'
+
+    if port_naming_key:
+        port_naming = utils.global_config[port_naming_key]
+    else:
+        return
+
+    prev_ctslotmezz = None
+    p_i = 0
+
+    for port in ports:
+        if 'name' in port:
+            continue # it already has a name so skip
+
+        if 'port_type' in port and 'controller' in port:
+            port_type = port['port_type']
+            if port_type == 'eth_roce':
+                port_type = 'eth'
+
+            # because we don't have an indication on when we switch to the next card we need to
+            # use this slightly messy approach.
+
+            if 'pci_slot' in port:
+                if prev_ctslotmezz != (port['controller'] + str(port['pci_slot'])):
+                    p_i = port_naming[port['pci_slot']][port_type]
+                    prev_ctslotmezz = port['controller'] + str(port['pci_slot'])
+            elif 'mezz' in port:
+                if prev_ctslotmezz != (port['controller'] + 'mezz'):
+                    p_i = port_naming['mezz'][port_type]
+                    prev_ctslotmezz = port['controller'] + 'mezz'
+            else:
+                continue
+
+
+            # special case the management port on the xcr4
+            # if port_naming_key == 'port_naming_xcr4' and port['pci_slot'] == 0:
+            #    if port['pci_card'] == 'mgmt2ethbaset' and p_i == 6:
+            #        p_i = 5
+            #    elif port['pci_card'] == 'mgmt2ethbaset' and p_i == 5:
+            #        p_i = 7
+
+            # Add the name to the port
+            # special case the management port in slot 0
+            if port_naming_key == 'port_naming_xcr4' and port['pci_slot'] == 0 \
+                      and port['pci_card'] == 'mgmt2ethbaset' and p_i == 6:
+                port['name'] = f"{port['controller']}.{port_type}5"
+            else:
+                port['name'] = f"{port['controller']}.{port_type}{p_i}"
+            # Increment the counter
+            p_i += 1
+
+
+def dp_label_text(dp_size):
+    """The label of a datapack of dp_size, TB is added to plain numbers"""
+    if dp_size.replace('.', '', 1).isdigit():
+        return str(dp_size) + "TB"
+    return dp_size
+
+
+def second_nvram(config):
+    """Whether the chassis has a second NVRAM, the base image already has one"""
+    #base image already has 1 NVRAM populated, so this is only for the second one.
+    if config['chassis_gen'] == '2':
+        #gen 2 chassis don't use nvrams
+        return False
+
+    if config['generation'] == 'c':
+        # always add second nvram on 'c' array
+        if config["model_num"] < 60:
+            # Don't add second nvram on c40 or c50
+            return False
+        # C60 & c70 do have 4 nvrams
+        pass
+    elif  config['generation'] == 'e':
+        # e uses distrubted NVRAM, so todo:
+        # Need to change the base image in order to remove
+        # and then re-add NVRams.... or add a blank to cover
+        # the base image.
+        return False
+    elif config['generation'] == 'xl':
+        return False
+    elif config["model_num"] < 70:
+        # Don't add second nvram on less  than 70
+        return False
+    return True
+
+
+def chassis_key(c):
+    """The image key of the chassis for config c and whether it's the bezel"""
+    key = f"png/pure_fa_{c['generation']}_r{c['release']}{c['rev']}"
+
+    chassis_gen = ""
+    if c["face"] == "front":
+        if c["bezel"]:
+            return key + "_bezel.png", True
+
+        if c['release'] in [1] and c['generation'] in ['c', 'e'] or (
+            c['release'] >= 4 and c['generation'] in ['x', 'c']
+        ):
+            # check for the next generation chassis
+            if c['chassis_gen'] == '2':
+                chassis_gen = "_cg2"
+
+    # not doing bezel
+    return key + f"_{c['face']}{chassis_gen}.png", False
+
+
+def place_chassis_fms(config, fm_loc):
+    """Works out the slot of every flash module in the chassis datapacks.
+
+    Returns a copy of the chassis datapacks with the first and last module
+    locations of each and whether they are rotated appended (a second range
+    when the datapack wraps round), the labels and the JSON response use
+    them.  Then the number of slots, the last slot that isn't rotated, a
+    (datapack index, slot) for each module to paste and the type in each
+    filled slot.
+    """
+    # is  this the right side data pack ?
+    # starts with no, then we change to yes if it's the last datapack.
+    right = False
+    slots = {}
+    placements = []
+
+    # todo add these details into the config.yaml
+    total_fm_count = 20
+    rotate_after = 1000 # i.e. no rotation
+
+    if config['generation'] == 'xl':
+        total_fm_count = 40
+        rotate_after = 40 #i.e. no rotation
+
+    elif config['chassis_gen'] == '2':
+        total_fm_count = 28
+        rotate_after = 19
+
+    current_index = 0
+    datapacks = [list(dp) for dp in config["chassis_datapacks"]]
+    dp_count = len(datapacks)
+
+    for dp_i in range(dp_count):
+        dp = datapacks[dp_i]
+        dpv2_start_index = -1
+
+        if len(dp) > 4:
+            # we are storing values in a list which should be a dictionary
+            # as each index corresponds to a different value.
+            # however, we are re-using it to pass fm loc, so we need to pull out this extra value
+            # and then remove it from the list so it doesn't break the rest of the code.
+            dpv2_start_index = dp[4]
+            del dp[4]
+
+        # see if this is the last data pack or not
+        if dp_i > 0 and dp_i + 1 == dp_count:
+            # If it's m or X need to populated the
+            # last datapack from the right side
+
+            # new 8/22/2025 only populate from the right if we have scm in slot 0
+            if config['generation'] != 'xl' and config['generation'] != 'c' and slots[0] == 'scm':
+                right = True
+
+        fm_type = dp[1]
+        num_modules = dp[2]
+
+        if not right:
+            the_range = list(range(current_index, current_index + num_modules))
+            current_index += num_modules
+        else:
+            the_range = list(range(total_fm_count-num_modules, total_fm_count))
+
+        #dp version2
+        if dpv2_start_index != -1:
+            the_range = list(range(dpv2_start_index, dpv2_start_index + num_modules))
+            current_index = the_range[-1] + 1
+
+        first_fm = True # used store the first fm location
+        for x in the_range:
+            if x >= total_fm_count:
+                raise InvalidConfigurationException(
+                    f"Too many fm modules, check data pack sizes dont exceed chassis size of {total_fm_count}" )
+            if first_fm:
+                dp.append(fm_loc[x]) # dp[4] is the start location of the DP
+                dp.append(fm_loc[x]) # dp[5] is the end, but we just put this as initial, it will be updated later
+                dp.append(x > rotate_after) # rotate after
+                first_fm = False
+
+            if len(dp) == 7: #Length of 7 means we have a continious DP so far,
+                if fm_loc[x][0] >= dp[5][0] :
+                    # The x is to the right, so just update the current DP range with new furthest FM loc
+                    dp[5] = fm_loc[x]
+                else:
+                    # We are starting a new range because the x is to the left,
+                    # these will be in location dp[6] and dp[7]
+                    dp.append(fm_loc[x])
+                    dp.append(fm_loc[the_range[-1]])
+                    dp.append(x > rotate_after) # rotate after
+
+            if x in slots and slots[x] != "blank":
+                if fm_type == "blank":
+                    pass
+                else:
+                    raise InvalidConfigurationException(
+                        f"Overlapping datapacks, check data pack sizes dont exceed chassis size of {total_fm_count}")
+            else:
+                # check to make sure index is not out of range:
+                if x >= len(fm_loc):
+                    raise InvalidConfigurationException(
+                        f"Too many fm modules, check data pack sizes dont exceed chassis size of {total_fm_count}" )
+
+                placements.append((dp_i, x))
+                # keep track of modules, to detect overlaps
+                slots[x] = fm_type
+
+    return datapacks, total_fm_count, rotate_after, placements, slots
+
+
+def place_shelf_nvme_fms(config, fm_loc):
+    """Works out the slot of every flash module in an NVMe shelf's datapacks.
+
+    Returns a copy of the datapacks with the module locations appended like
+    place_chassis_fms(), the last slot that isn't rotated and a
+    (datapack index, slot) for each module to paste.
+    """
+    cur_module = 0
+    placements = []
+
+    total_fm_count = 28
+    rotate_after = 19
+
+    datapacks = [list(dp) for dp in config["datapacks"]]
+    for dp_i, dp in enumerate(datapacks):
+        dpv2_start_index = -1
+
+        if len(dp) > 4:
+            # we are storing values in a list which should be a dictionary
+            # as each index corresponds to a different value.
+            # however, we are re-using it to pass fm loc, so we need to pull out this extra value
+            # and then remove it from the list so it doesn't break the rest of the code.
+            dpv2_start_index = dp[4]
+            del dp[4]
+
+        fm_str = dp[0]
+        num_modules = dp[2]
+
+        if fm_str == 'Blank':
+            num_modules = 14
+
+        first_fm = True
+        the_range = list(range(cur_module, min(28, num_modules + cur_module)))
+        cur_module += num_modules
+        # curr_modules keeps track of next free location
+        # however with dpv2 they can pass in their own.
+        if dpv2_start_index != -1:
+            the_range = list(range(dpv2_start_index, dpv2_start_index + num_modules))
+            cur_module = dpv2_start_index + num_modules
+        for x in the_range:
+            if x >= total_fm_count:
+                raise InvalidConfigurationException(
+                    f"Too many fm modules, check data pack sizes dont exceed chassis size of {total_fm_count}" )
+
+            if first_fm:
+                dp.append(fm_loc[x])
+                dp.append(fm_loc[x])
+                dp.append(x > rotate_after) # rotate after
+                first_fm = False
+
+            if len(dp) == 7: #Length of 7 means we have a continious DP so far,
+                if fm_loc[x][0] >= dp[5][0] :
+                    # The x is to the right, so just update the current DP range with new furthest FM loc
+                    dp[5] = fm_loc[x]
+                else:
+                    # We are starting a new range because the x is to the left,
+                    # these will be in location dp[6] and dp[7]
+                    dp.append(fm_loc[x])
+                    dp.append(fm_loc[the_range[-1]])
+                    dp.append(x > rotate_after) # rotate after
+
+            placements.append((dp_i, x))
+
+    return datapacks, rotate_after, placements
 
 
 def apply_fm_label(fm_img, fm_str, fm_type):
@@ -743,6 +693,76 @@ def apply_fm_label(fm_img, fm_str, fm_type):
     if fm_type != "blank":
         utils.apply_text_centered(fm_img, fm_type, 32)
 
+
+# finished flash modules, labeled and/or rotated.  Every chassis, shelf and
+# blade with the same module shares one image instead of labeling and
+# rotating a copy per datapack or per slot.
+fm_cache_mb = int(os.environ.get('RACKDIAGRAM_FM_CACHE_MB', 32))
+fm_cache = LRUCache(fm_cache_mb * 1024 * 1024, name="fm")
+
+
+async def get_fm_image(img_key, fm_str, fm_type, label=True, rotated=False, json_only=False):
+    """Returns the flash module image img_key, labeled with fm_str and fm_type
+    when label is set and rotated -90 degrees when rotated is set.
+
+    The image is shared, paste it into something else rather than drawing on it.
+    """
+    if json_only:
+        fm_img = await RackImage(img_key, json_only).get_sprite()
+        if rotated:
+            fm_img = fm_img.rotate(-90, expand=True)
+        return fm_img
+
+    if not label:
+        if not rotated:
+            # the plain asset, nothing to cache
+            return await RackImage(img_key).get_sprite()
+        fm_str = fm_type = None
+
+    key = (img_key, fm_str, fm_type, label, rotated)
+    fm_img = fm_cache.get(key)
+    if fm_img is None:
+        if rotated:
+            fm_img = await get_fm_image(img_key, fm_str, fm_type, label)
+            fm_img = fm_img.rotate(-90, expand=True)
+        else:
+            # the label is drawn on the module, so we need our own copy
+            fm_img = await RackImage(img_key).get_image()
+            apply_fm_label(fm_img, fm_str, fm_type)
+        fm_cache.put(key, fm_img, image_nbytes(fm_img))
+    return utils.read_only_handle(fm_img)
+
+def _composite_dp_box(img, rect, text_loc, text):
+    """Blends the translucent datapack box and its text onto img.
+
+    Only the region the box and text cover is composited, in place when img
+    is already RGBA, instead of building a chassis sized overlay and
+    compositing the whole image.  Everything outside the overlay is fully
+    transparent so the result is the same.
+    """
+    (x0, y0), (x1, y1) = rect
+    tx0, ty0, tx1, ty1 = text_box(text_loc, text, 85)
+    # keep the text origin inside the overlay, a negative relative position
+    # would rasterise with a different fractional start
+    left = max(0, min(x0, tx0, int(text_loc[0])))
+    top = max(0, min(y0, ty0, int(text_loc[1])))
+    right = min(img.size[0], max(x1 + 1, tx1))
+    bottom = min(img.size[1], max(y1 + 1, ty1))
+
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    if right <= left or bottom <= top:
+        return img
+
+    overlay = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+    ImageDraw.Draw(overlay).rectangle(((x0 - left, y0 - top), (x1 - left, y1 - top)),
+                                      fill=(199, 89, 40, 127))
+    draw_text(overlay, (text_loc[0] - left, text_loc[1] - top), text, 85,
+              (255, 255, 255, 220))
+    img.alpha_composite(overlay, (left, top))
+    return img
+
+
 def apply_dp_labelv2(img, dp_size, start_loc_provided, end_loc_provided, rotated=False):
     if dp_size == '0TB':
         return img
@@ -751,13 +771,6 @@ def apply_dp_labelv2(img, dp_size, start_loc_provided, end_loc_provided, rotated
     if hasattr(img, '__class__') and img.__class__.__name__ == 'MockImage':
         return img  # For MockImages, just return the original image
     
-    global ttf_path
-    # temp image same size as our chassis.
-    tmp = Image.new('RGBA', img.size, (0, 0, 0, 0))
-
-    # Create a drawing context for it.
-    draw = ImageDraw.Draw(tmp)
-
     x_buffer = 50
     y_buffer = 75
     y_size = 420
@@ -779,12 +792,10 @@ def apply_dp_labelv2(img, dp_size, start_loc_provided, end_loc_provided, rotated
     end_loc = (end_loc[0] + x_buffer + x_size,
                 (end_loc[1] + y_size))
 
-    draw.rectangle((box_loc, end_loc), fill=(199, 89, 40, 127))
     box_center = ((box_loc[0] + end_loc[0]) // 2,
                   (box_loc[1] + end_loc[1]) // 2)
-    font = ImageFont.truetype(ttf_path, size=85)
     #w, h = draw.textsize(dp_size, font=font)
-    _,_,w,h = draw.textbbox((0,0), text=dp_size, font=font)
+    _,_,w,h = text_bbox(dp_size, 85)
 
     #if w!=w_new or h !=h_new :
     #    Exception("new bbox wrong values")
@@ -792,61 +803,40 @@ def apply_dp_labelv2(img, dp_size, start_loc_provided, end_loc_provided, rotated
     
 
     text_loc = (box_center[0] - w/2, box_center[1] - h/2)
-    draw.text(text_loc, dp_size , fill=(255, 255, 255, 220), font=font)
-    #logger.debug("converting image to RGBA")
-    alpha_tmp = img.convert("RGBA")
-    #logger.debug("converted image to RGBA, doing composite")
-    composite_img = Image.alpha_composite(alpha_tmp, tmp)
-    #logger.debug("done composite")
-    return composite_img
+    return _composite_dp_box(img, (box_loc, end_loc), text_loc, dp_size)
 
 def apply_dp_label(img, dp_size, x_offset, y_offset, right, full=False):
     # Handle MockImage case early
     if hasattr(img, '__class__') and img.__class__.__name__ == 'MockImage':
         return img  # For MockImages, just return the original image
         
-    global ttf_path
-    # temp image same size as our chassis.
-    tmp = Image.new('RGBA', img.size, (0, 0, 0, 0))
-
-    # Create a drawing context for it.
-    draw = ImageDraw.Draw(tmp)
-
     x_buffer = 75
     y_buffer = 60
 
     box_loc = (x_offset + x_buffer, y_offset + y_buffer)
 
     if right:
-        box_loc = (tmp.size[0] // 2 + x_buffer, y_offset + y_buffer)
+        box_loc = (img.size[0] // 2 + x_buffer, y_offset + y_buffer)
 
-    box_size = (tmp.size[0] // 2 - 2 * x_buffer - x_offset,
-                (tmp.size[1] - 2 * y_buffer - y_offset))
+    box_size = (img.size[0] // 2 - 2 * x_buffer - x_offset,
+                (img.size[1] - 2 * y_buffer - y_offset))
     if full:
-        box_size = (tmp.size[0] - 2 * x_buffer - 2 * x_offset,
-                    (tmp.size[1] - 2 * y_buffer - y_offset))
+        box_size = (img.size[0] - 2 * x_buffer - 2 * x_offset,
+                    (img.size[1] - 2 * y_buffer - y_offset))
 
     # put DP on left or right
     box_loc2 = (box_loc[0]+box_size[0], box_loc[1]+box_size[1])
 
-    draw.rectangle((box_loc, box_loc2), fill=(199, 89, 40, 127))
     box_center = ((box_loc[0] + box_loc2[0]) // 2,
                   (box_loc[1] + box_loc2[1]) // 2)
-    font = ImageFont.truetype(ttf_path, size=85)
     #w, h = draw.textsize(dp_size + "TB", font=font)
-    _,_,w,h = draw.textbbox((0,0), text=dp_size + "TB", font=font)
+    _,_,w,h = text_bbox(dp_size + "TB", 85)
     #if w!=w_new or h !=h_new :
     #    Exception("new bbox wrong values")
 
 
     text_loc = (box_center[0] - w/2, box_center[1] - h/2)
-    draw.text(text_loc, dp_size + "TB", fill=(255, 255, 255, 220), font=font)
-    #logger.debug("converting image to RGBA")
-    alpha_tmp = img.convert("RGBA")
-    #logger.debug("converted image to RGBA, doing composite")
-    composite_img = Image.alpha_composite(alpha_tmp, tmp)
-    #logger.debug("done composite")
-    return composite_img
+    return _composite_dp_box(img, (box_loc, box_loc2), text_loc, dp_size + "TB")
 
 
 # FADiagram does most of the logical config parsing and validation of configuration
@@ -1405,14 +1395,18 @@ class FADiagram():
     async def get_image(self):
         tasks = []
 
+        # components other requests have drawn already come from the cache,
+        # along with what drawing them added to the datapacks
         chassis_config = self.config.copy()
         chassis_config['json_only'] = self.json_only
-        tasks.append(FAChassis(chassis_config).get_image())
+        tasks.append(get_component('fa_chassis', FAChassis.cache_key_fields(chassis_config),
+                                   FAChassis(chassis_config).get_image, chassis_config))
 
         for shelf in self.config["shelves"]:
             shelf_config = shelf.copy()
             shelf_config['json_only'] = self.json_only
-            tasks.append(FAShelf(shelf_config).get_image())
+            tasks.append(get_component('fa_shelf', shelf_config,
+                                       FAShelf(shelf_config).get_image, shelf_config))
 
         # this returns the results of the all the tasks in a list
         all_image_ports = await asyncio.gather(*tasks)
@@ -1421,6 +1415,30 @@ class FADiagram():
             all_image_ports.reverse()
 
         return all_image_ports
+
+    def plan(self):
+        """The render plan of each component in the order get_image() returns
+        them, see renderplan.  The config is left as it is."""
+        plans = [FAChassis(self.config.copy()).plan()]
+        for shelf in self.config["shelves"]:
+            plans.append(FAShelf(shelf.copy()).plan())
+
+        if self.config["direction"] == "up":
+            plans.reverse()
+
+        return plans
+
+    def layout(self):
+        """What get_image() returns in json_only mode, {'size', 'ports'} for
+        each component rather than {'img', 'ports'}, without any images"""
+        all_layouts = [FAChassis(self.config.copy()).layout()]
+        for shelf in self.config["shelves"]:
+            all_layouts.append(FAShelf(shelf.copy()).layout())
+
+        if self.config["direction"] == "up":
+            all_layouts.reverse()
+
+        return all_layouts
     
         #final_img, all_ports = combine_images_vertically(all_image_ports)
         #self.ports = all_ports
@@ -4,7 +4,9 @@ from os.path import join
 from PIL import ImageDraw
 from PIL import ImageFont
 
-from .utils import RackImage, add_ports_at_offset, global_config, apply_text, InvalidConfigurationException
+from .utils import add_ports_at_offset, global_config, InvalidConfigurationException
+from .renderplan import new_plan, centered_text_op, plan_layout, execute_plan
+from .componentcache import get_component
 
 
 class FBDiagram():
@@ -92,22 +94,31 @@ class FBDiagram():
 
         self.config = config
 
+    def chassis_image_key(self):
+        """The image key of the chassis for the face and efm"""
+        if self.config["face"] == 'front':
+            return "png/pure_fb_front.png"
+        return "png/pure_fb_back_{}.png".format(self.config['efm'])
+
     async def build_chassis(self, number):
         face = self.config["face"]
-        if face == 'front':
-            img_key = "png/pure_fb_front.png"
-        else:
-            img_key = "png/pure_fb_back_{}.png".format(self.config['efm'])
-
-        if img_key in global_config:
-            self.img_info = global_config[img_key]
-
-        ports = []
-        add_ports_at_offset(img_key, (0, 0), ports)
-
-        img = await RackImage(img_key, self.json_only).get_image()
+        img_key = self.chassis_image_key()
 
+        # identical chassis (the backs, unlabelled fronts) are drawn once
+        fields = {'img_key': img_key, 'json_only': self.json_only}
         if face == "front":
+            blade_labels = self.config['blade_labels']
+            fields['labels'] = [blade_labels.get(number * 15 + index) for index in range(15)]
+        return await get_component('fb_chassis', fields, lambda: self.draw(self.chassis_plan(number)))
+
+    def chassis_plan(self, number):
+        """The render plan of chassis number, see renderplan"""
+        img_key = self.chassis_image_key()
+        plan = new_plan(img_key)
+        add_ports_at_offset(img_key, (0, 0), plan['ports'])
+
+        if self.config["face"] == "front":
+            # blade labels are drawn on the chassis
             blade_index_offset = number * 15
             x_offset = 260
             x_blade_size = 164
@@ -117,15 +128,25 @@ class FBDiagram():
                 if blade_num in self.config['blade_labels']:
                     label = self.config['blade_labels'][blade_num]
                     label = "{} TB".format(label)
-                    apply_text(img, label, x_offset +
-                               x_blade_size*index, y_offset, 36)
-
-        return {'img': img, 'ports': ports}
-
-    async def get_rack_image_with_ports(self, key):
-        ports = []
-        add_ports_at_offset(key, (0, 0), ports)
-        return {'img': await RackImage(key, self.json_only).get_image(), 'ports': ports}
+                    plan['ops'].append(centered_text_op(label, x_offset +
+                                       x_blade_size*index, y_offset, 36))
+        return plan
+
+    def xfm_plan(self):
+        """The render plan of an XFM, see renderplan"""
+        key = f"png/pure_fb_xfm_{self.config['xfm_model']}_{self.config['xfm_face']}.png"
+        plan = new_plan(key)
+        add_ports_at_offset(key, (0, 0), plan['ports'])
+        return plan
+
+    async def draw(self, plan):
+        return {'img': await execute_plan(plan, self.json_only), 'ports': plan['ports']}
+
+    async def get_xfm(self):
+        # both fabric modules are the same, loaded once and shared
+        plan = self.xfm_plan()
+        return await get_component('xfm', {'img_key': plan['base'], 'json_only': self.json_only},
+                                   lambda: self.draw(plan))
 
     async def get_image(self):
         tasks = []
@@ -134,10 +155,8 @@ class FBDiagram():
             tasks.append(self.build_chassis(i))
 
         if self.config['xfm']:
-            xfm_face = self.config['xfm_face']
             for x in range(2):
-                tasks.append(
-                self.get_rack_image_with_ports(f"png/pure_fb_xfm_{self.config['xfm_model']}_{xfm_face}.png"))
+                tasks.append(self.get_xfm())
             
 
         all_images = await asyncio.gather(*tasks)
@@ -149,3 +168,20 @@ class FBDiagram():
         # final_img, all_ports = combine_images_vertically(all_images)
         # self.ports = all_ports
         # return final_img
+
+    def plan(self):
+        """The render plan of each component in the order get_image() returns
+        them, see renderplan"""
+        plans = [self.chassis_plan(i) for i in range(self.config["chassis"])]
+        if self.config['xfm']:
+            plans += [self.xfm_plan() for x in range(2)]
+
+        if self.config["direction"] == "up":
+            plans.reverse()
+
+        return plans
+
+    def layout(self):
+        """What get_image() returns in json_only mode, {'size', 'ports'} for
+        each component rather than {'img', 'ports'}, without any images"""
+        return [plan_layout(plan) for plan in self.plan()]
@@ -1,16 +1,15 @@
 import asyncio
 from cmath import exp
 from os.path import join
-from PIL import ImageDraw
-from PIL import Image
-from PIL import ImageFont
 # Import custom exceptions
 import sys
 import re
 from .utils import InvalidConfigurationException, InvalidDatapackException, RackDiagramException
 from .utils import RackImage, add_ports_at_offset, combine_images_vertically, global_config, apply_text, bool_param_get
+from .renderplan import (new_plan, fm_sprite, label_sprite, plan_sprite, paste_op,
+                         plan_layout, execute_plan)
 
-from .flasharray import apply_fm_label
+from .componentcache import get_component
 import logging
 
 import jsonurl_py as jsonurl
@@ -288,117 +287,70 @@ class FBSDiagram():
         
         return config
 
-    async def add_blades(self, base_img, number_of_blades, blade_model_text, chassis_idx=0):
+    def plan_blades(self, plan, img_info, number_of_blades, blade_model_text, chassis_idx=0):
         logging.debug("Adding blades to the image")
         
         # Check if using bladesv2
         if 'bladesv2_final' in self.config:
-            await self._add_blades_v2(base_img, chassis_idx, blade_model_text)
+            self._plan_blades_v2(plan, img_info, chassis_idx, blade_model_text)
         else:
-            await self._add_blades_legacy(base_img, number_of_blades, blade_model_text)
+            self._plan_blades_legacy(plan, img_info, number_of_blades, blade_model_text)
 
-    async def _add_blades_legacy(self, base_img, number_of_blades, blade_model_text):
-        """Legacy blade addition logic"""
+    def blade_plan(self, fms, blade_model_text):
+        """The render plan of a blade with a DFM of each (size, location) in fms"""
         key = 'png/pure_fbs_blade.png'
-        blade_img = await RackImage(key, self.json_only).get_image()
-        fm_loc = global_config[key]['fm_loc']
+        blade = new_plan(key)
 
         dfm_name = 'png/pure_fa_fm_nvme.png'
-        fm_img = await RackImage(dfm_name, self.json_only).get_image()
-        apply_fm_label(fm_img, str(self.config['dfm_size']), "qlc")
-
-        # Paste in the DFMs
-        for x in range(self.config['dfm_count']):
-            blade_img.paste(fm_img, fm_loc[x])
+        for fm_size, loc in fms:
+            blade['ops'].append(paste_op(fm_sprite(dfm_name, fm_size, "qlc"), loc))
 
         # Add model label
         label_loc = global_config[key]['model_text_loc']
-        # Move text 4 pixels higher (reduce y coordinate by 4)
-        label_loc = (label_loc[0], label_loc[1])
-        ttf_path = global_config['ttf_path']
-        font_size = 24
-
-        font = ImageFont.truetype(ttf_path, size=font_size)
-        _, _, w, h = font.getbbox(blade_model_text)
-        txt_size = (w, h)
-        
-        txtimg = Image.new("RGBA", txt_size, (38, 38, 38))
-        txtimg_draw = ImageDraw.Draw(txtimg)
-        txtimg_draw.text((0,0), blade_model_text, font=font, fill= (255, 255, 255))
+        # white on the blade grey, rotated to run down the blade
+        label = label_sprite(blade_model_text, 24, (255, 255, 255), (38, 38, 38), 270, top_crop=3)
+        blade['ops'].append(paste_op(label, label_loc))
+        return blade
 
-        top_crop = 3
-        txtimg = txtimg.crop((0, top_crop, txt_size[0], txt_size[1]))
-        txtimg = txtimg.rotate(270, expand=1)
-        blade_img.paste(txtimg, label_loc)
+    def _plan_blades_legacy(self, plan, img_info, number_of_blades, blade_model_text):
+        """Legacy blade addition logic"""
+        fm_loc = global_config['png/pure_fbs_blade.png']['fm_loc']
+        fms = [(str(self.config['dfm_size']), fm_loc[x]) for x in range(self.config['dfm_count'])]
+        blade = plan_sprite(self.blade_plan(fms, blade_model_text))
 
-        # Paste in the blades
+        # Paste in the blades, all the same
         for x in range(number_of_blades):
-            base_img.paste(blade_img, self.img_info['blade_loc'][x])
+            plan['ops'].append(paste_op(blade, img_info['blade_loc'][x]))
 
-    async def _add_blades_v2(self, base_img, chassis_idx, blade_model_text):
+    def _plan_blades_v2(self, plan, img_info, chassis_idx, blade_model_text):
         """Advanced blade addition logic for bladesv2 using final data model"""
         if chassis_idx >= len(self.config['bladesv2_final']):
             return
             
         chassis_blades = self.config['bladesv2_final'][chassis_idx]
-        key = 'png/pure_fbs_blade.png'
-        fm_loc = global_config[key]['fm_loc']
+        fm_loc = global_config['png/pure_fbs_blade.png']['fm_loc']
         
         # Process each blade (0-9) in this chassis
         for blade_idx, blade_bays in enumerate(chassis_blades):
-            if blade_idx >= len(self.img_info['blade_loc']):
+            if blade_idx >= len(img_info['blade_loc']):
                 continue
                 
             # Check if this blade has any DFMs configured
             if not any(bay is not None for bay in blade_bays):
                 continue
                 
-            # Create blade image for this specific blade
-            blade_img = await RackImage(key, self.json_only).get_image()
-            
             # Add FMs to each bay in this blade based on configuration
-            for bay_idx, fm_config in enumerate(blade_bays):
-                if fm_config is None or bay_idx >= len(fm_loc):
-                    continue
-                    
-                # Create FM with specific size
-                fm_name = 'png/pure_fa_fm_nvme.png'
-                fm_img = await RackImage(fm_name, self.json_only).get_image()
-                apply_fm_label(fm_img, str(fm_config['fm_size']), "qlc")
-                
-                # Paste this FM into the specific bay location on the blade
-                blade_img.paste(fm_img, fm_loc[bay_idx])
-
-            # Add model label to the blade
-            label_loc = global_config[key]['model_text_loc']
-            # Move text 4 pixels higher (reduce y coordinate by 4)
-            label_loc = (label_loc[0], label_loc[1])
-            ttf_path = global_config['ttf_path']
-            font_size = 24
-
-            font = ImageFont.truetype(ttf_path, size=font_size)
-            _, _, w, h = font.getbbox(blade_model_text)
-            txt_size = (w, h)
-            
-            txtimg = Image.new("RGBA", txt_size, (38, 38, 38))
-            txtimg_draw = ImageDraw.Draw(txtimg)
-            txtimg_draw.text((0,0), blade_model_text, font=font, fill= (255, 255, 255))
-
-            top_crop = 3
-            txtimg = txtimg.crop((0, top_crop, txt_size[0], txt_size[1]))
-            txtimg = txtimg.rotate(270, expand=1)
-            blade_img.paste(txtimg, label_loc)
+            fms = [(str(fm_config['fm_size']), fm_loc[bay_idx])
+                   for bay_idx, fm_config in enumerate(blade_bays)
+                   if fm_config is not None and bay_idx < len(fm_loc)]
 
             # Paste this completed blade into the chassis
-            base_img.paste(blade_img, self.img_info['blade_loc'][blade_idx])
+            blade = plan_sprite(self.blade_plan(fms, blade_model_text))
+            plan['ops'].append(paste_op(blade, img_info['blade_loc'][blade_idx]))
 
 
-    async def build_chassis(self, number_of_blades, blade_model_text, chassis_idx=0):
-        logging.debug("Building chassis with %s blades", number_of_blades)
-        # For legacy mode, limit to 10 blades per chassis
-        if 'bladesv2_final' not in self.config:
-            number_of_blades = min(10, number_of_blades)
-        
+    def chassis_image_key(self, blade_model_text):
+        """The image key of a chassis with blade_model_text blades"""
         face = self.config["face"]
         model = blade_model_text[0].lower()
 
@@ -409,30 +361,60 @@ class FBSDiagram():
                 img_key = f"png/pure_fb{model}_front.png"
         else:
             img_key = f"png/pure_fb{model}_back.png"
+        return img_key
 
-        if img_key in global_config:
-            self.img_info = global_config[img_key]
-
-        ports = []
-        add_ports_at_offset(img_key, (0, 0), ports)
-
-        base_img = await RackImage(img_key, self.json_only).get_image()
+    async def build_chassis(self, number_of_blades, blade_model_text, chassis_idx=0):
+        logging.debug("Building chassis with %s blades", number_of_blades)
+        img_key = self.chassis_image_key(blade_model_text)
 
+        # the same chassis turns up in many requests, drawn ones come from
+        # the component cache
+        fields = {'img_key': img_key, 'json_only': self.json_only}
         if "front" in img_key:
-            await self.add_blades(base_img, number_of_blades, blade_model_text, chassis_idx)
-
-        return {'img': base_img, 'ports': ports}
-
-    async def get_rack_image_with_ports(self, key):
-        ports = []
-        add_ports_at_offset(key, (0, 0), ports)
-        return {'img': await RackImage(key, self.json_only).get_image(), 'ports': ports}
+            fields['blade_model_text'] = blade_model_text
+            if 'bladesv2_final' in self.config:
+                bladesv2_final = self.config['bladesv2_final']
+                fields['blades'] = bladesv2_final[chassis_idx] if chassis_idx < len(bladesv2_final) else None
+            else:
+                fields['blades'] = max(0, number_of_blades)
+                fields['dfm_size'] = self.config['dfm_size']
+                fields['dfm_count'] = self.config['dfm_count']
 
-    async def get_image(self):
-        tasks = []
+        return await get_component(
+            'fbs_chassis', fields,
+            lambda: self.draw(self.chassis_plan(number_of_blades, blade_model_text, chassis_idx)))
 
-        logging.debug("Starting to get image for configuration: %s", str(self.config))
+    def chassis_plan(self, number_of_blades, blade_model_text, chassis_idx=0):
+        """The render plan of a chassis, see renderplan"""
+        img_key = self.chassis_image_key(blade_model_text)
+        plan = new_plan(img_key)
+        add_ports_at_offset(img_key, (0, 0), plan['ports'])
 
+        if "front" in img_key:
+            # blades get pasted onto the chassis
+            self.plan_blades(plan, global_config[img_key], number_of_blades,
+                             blade_model_text, chassis_idx)
+        return plan
+
+    def xfm_plan(self):
+        """The render plan of an XFM, see renderplan"""
+        key = f"png/pure_fb_xfm_{self.config['xfm_model']}_{self.config['xfm_face']}.png"
+        plan = new_plan(key)
+        add_ports_at_offset(key, (0, 0), plan['ports'])
+        return plan
+
+    async def draw(self, plan):
+        return {'img': await execute_plan(plan, self.json_only), 'ports': plan['ports']}
+
+    async def get_xfm(self):
+        # both fabric modules are the same, loaded once and shared
+        plan = self.xfm_plan()
+        return await get_component('xfm', {'img_key': plan['base'], 'json_only': self.json_only},
+                                   lambda: self.draw(plan))
+
+    def chassis_specs(self):
+        """(number of blades, blade model text, chassis index) for each chassis"""
+        specs = []
         c = self.config
         blade_model_text = self._generate_blade_model_text_from_parsed(self.config['model_parsed'])
 
@@ -449,8 +431,8 @@ class FBSDiagram():
             # Use bladesv2 configuration
             for i in range(self.config["chassis"]):
                 # For bladesv2, we don't need to track blades_left since it's managed per chassis
-                tasks.append(self.build_chassis(0, blade_model_text, i))
-                
+                specs.append((0, blade_model_text, i))
+
                 # expansions shelves we change the blade model to EX (EC → EX, ECR2 → EXR2, etc.)
                 if blade_model_text.startswith("EC"):
                     blade_model_text = blade_model_text.replace("EC", "EX", 1)
@@ -458,18 +440,26 @@ class FBSDiagram():
             # Legacy blade processing
             blades_left = c['blades']
             for i in range(self.config["chassis"]):
-                tasks.append(self.build_chassis(blades_left, blade_model_text, i))
+                # For legacy mode, limit to 10 blades per chassis
+                specs.append((min(10, blades_left), blade_model_text, i))
                 blades_left -= 10
 
                 # expansions shelves we change the blade model to EX (EC → EX, ECR2 → EXR2, etc.)
                 if blade_model_text.startswith("EC"):
                     blade_model_text = blade_model_text.replace("EC", "EX", 1)
+        return specs
+
+    async def get_image(self):
+        tasks = []
+
+        logging.debug("Starting to get image for configuration: %s", str(self.config))
+
+        for number_of_blades, blade_model_text, chassis_idx in self.chassis_specs():
+            tasks.append(self.build_chassis(number_of_blades, blade_model_text, chassis_idx))
 
         if self.config['xfm']:
-            xfm_face = self.config['xfm_face']
             for x in range(2):
-                tasks.append(
-                self.get_rack_image_with_ports(f"png/pure_fb_xfm_{self.config['xfm_model']}_{xfm_face}.png"))
+                tasks.append(self.get_xfm())
             
 
         all_images = await asyncio.gather(*tasks)
@@ -481,3 +471,20 @@ class FBSDiagram():
         # final_img, all_ports = combine_images_vertically(all_images)
         # self.ports = all_ports
         # return final_img
+
+    def plan(self):
+        """The render plan of each component in the order get_image() returns
+        them, see renderplan"""
+        plans = [self.chassis_plan(*spec) for spec in self.chassis_specs()]
+        if self.config['xfm']:
+            plans += [self.xfm_plan() for x in range(2)]
+
+        if self.config["direction"] == "up":
+            plans.reverse()
+
+        return plans
+
+    def layout(self):
+        """What get_image() returns in json_only mode, {'size', 'ports'} for
+        each component rather than {'img', 'ports'}, without any images"""
+        return [plan_layout(plan) for plan in self.plan()]
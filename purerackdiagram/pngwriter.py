@@ -0,0 +1,225 @@
+"""Streaming PNG output.
+
+combine_images_vertically() has to hold the whole rack as one image before
+it can be saved, for a tall rack that is the biggest allocation of the
+request.  write_png_vertically() writes the same picture straight into a
+PNG a band of rows at a time, so only one band of the rack is ever held
+uncompressed on top of the component images themselves.
+
+write_png_parallel() saves an image that is already built, deflating
+bands of rows on a pool of threads (zlib releases the GIL) the way pigz
+does.  Each band is raw deflate primed with the last 32K of the band
+before it and ends on a byte boundary, so the bands join into one zlib
+stream that compresses nearly as well as a single pass.
+
+The pixels are identical to saving the combined image with Pillow but the
+file bytes are not, rows are written unfiltered rather than with Pillow's
+adaptive filters.
+"""
+import concurrent.futures
+import os
+import struct
+import threading
+import zlib
+
+from .utils import vertical_layout
+
+# rows converted and compressed at a time
+band_rows = 256
+
+# the pool for write_png_parallel, sized to the cpu count unless
+# RACKDIAGRAM_ENCODE_WORKERS is set.
+encode_workers = int(os.environ.get('RACKDIAGRAM_ENCODE_WORKERS', 0)) or os.cpu_count() or 1
+encode_executor = None
+encode_executor_lock = threading.Lock()
+
+# the deflate window, each band is primed with this much of the one before
+window_size = 32 * 1024
+# smallest band worth handing to another thread
+min_band_bytes = 1024 * 1024
+
+# PNG colour type and bytes per pixel for the modes that are written as is
+png_modes = {'RGB': (2, 3), 'RGBA': (6, 4)}
+
+
+def _chunk(fp, tag, data):
+    fp.write(struct.pack(">I", len(data)))
+    fp.write(tag)
+    fp.write(data)
+    fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+
+def _adler32_combine(adler1, adler2, len2):
+    # adler32 of a + b from adler32(a), adler32(b) and len(b), as zlib's
+    # adler32_combine()
+    base = 65521
+    s1 = ((adler1 & 0xffff) + (adler2 & 0xffff) - 1) % base
+    s2 = ((adler1 >> 16) + (adler2 >> 16) + len2 * ((adler1 & 0xffff) - 1)) % base
+    return (s2 << 16) | s1
+
+
+def get_encode_executor():
+    """Returns the process wide executor used to deflate PNG bands"""
+    global encode_executor
+    with encode_executor_lock:
+        if encode_executor is None:
+            encode_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=encode_workers,
+                thread_name_prefix="rackdiagram-encode")
+        return encode_executor
+
+
+def _reset_encode_executor():
+    # threads don't survive a fork, the child has to build its own pool
+    global encode_executor
+    encode_executor = None
+
+
+os.register_at_fork(after_in_child=_reset_encode_executor)
+
+
+class PNGStreamWriter():
+    """Writes an 8 bit RGB PNG to fp from rows of raw RGB bytes"""
+
+    def __init__(self, fp, size, compress_level=6, idat_size=1 << 16):
+        self.fp = fp
+        self.size = size
+        self.stride = size[0] * 3
+        self.idat_size = idat_size
+        self.rows_written = 0
+        self.pending = []
+        self.pending_bytes = 0
+        self.compressor = zlib.compressobj(compress_level)
+
+        fp.write(b"\x89PNG\r\n\x1a\n")
+        _chunk(fp, b"IHDR", struct.pack(">IIBBBBB", size[0], size[1], 8, 2, 0, 0, 0))
+
+    def write_rows(self, data):
+        """Adds whole rows of RGB pixels, len(data) must be a multiple of the row size"""
+        rows = len(data) // self.stride
+        if rows * self.stride != len(data):
+            raise ValueError("data is not a whole number of rows")
+        if self.rows_written + rows > self.size[1]:
+            raise ValueError("more rows than the image height")
+
+        view = memoryview(data)
+        # each row starts with its filter type, 0 is none
+        scanlines = [b""]
+        scanlines.extend(view[i * self.stride:(i + 1) * self.stride] for i in range(rows))
+        self._add(self.compressor.compress(b"\x00".join(scanlines)))
+        self.rows_written += rows
+
+    def _add(self, data, flush=False):
+        if data:
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+        if self.pending_bytes >= self.idat_size or (flush and self.pending):
+            _chunk(self.fp, b"IDAT", b"".join(self.pending))
+            self.pending = []
+            self.pending_bytes = 0
+
+    def close(self):
+        if self.rows_written != self.size[1]:
+            raise ValueError(f"{self.rows_written} rows written for an image {self.size[1]} high")
+        self._add(self.compressor.flush(), flush=True)
+        _chunk(self.fp, b"IEND", b"")
+
+
+def write_png_vertically(fp, image_ports, compress_level=6):
+    """Writes the images stacked like combine_images_vertically() as a PNG to fp.
+
+    Returns the image size and the combined ports, the same as
+    combine_images_vertically() returns them.
+    """
+    size, placements, all_ports = vertical_layout(image_ports)
+    width = size[0]
+    writer = PNGStreamWriter(fp, size, compress_level)
+
+    for im, x_offset, _ in placements:
+        w, h = im.size
+        left = bytes(x_offset * 3)
+        right = bytes((width - w - x_offset) * 3)
+        for y in range(0, h, band_rows):
+            rows = min(band_rows, h - y)
+            band = im.crop((0, y, w, y + rows))
+            if band.mode != "RGB":
+                # drops the alpha, the same as the combined image does
+                band = band.convert("RGB")
+            raw = band.tobytes()
+            if left or right:
+                stride = w * 3
+                raw = b"".join(left + raw[i * stride:(i + 1) * stride] + right
+                               for i in range(rows))
+            writer.write_rows(raw)
+
+    writer.close()
+    return size, all_ports
+
+
+def _scanlines(img, top, bottom, stride):
+    # the rows top to bottom with the filter type, 0 is none, before each
+    raw = img.crop((0, top, img.size[0], bottom)).tobytes()
+    view = memoryview(raw)
+    scanlines = [b""]
+    scanlines.extend(view[i * stride:(i + 1) * stride] for i in range(bottom - top))
+    return b"\x00".join(scanlines)
+
+
+def _deflate_band(img, top, bottom, stride, compress_level, last):
+    data = _scanlines(img, top, bottom, stride)
+    zdict = None
+    if top > 0:
+        # the end of the band before, enough rows to fill the window
+        prime_top = max(0, top - (window_size + stride) // (stride + 1) - 1)
+        zdict = _scanlines(img, prime_top, top, stride)[-window_size:]
+
+    if zdict:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    # a sync flush ends the band on a byte boundary so the next one can
+    # follow it, only the last band finishes the stream
+    flush = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(data) + compressor.flush(flush), zlib.adler32(data), len(data)
+
+
+def write_png_parallel(fp, img, compress_level=6, workers=None):
+    """Writes img to fp as a PNG, deflating bands of rows in parallel.
+
+    img must be RGB or RGBA, anything else is converted to RGB first.
+    """
+    if img.mode not in png_modes:
+        img = img.convert("RGB")
+    color_type, bpp = png_modes[img.mode]
+    width, height = img.size
+    stride = width * bpp
+    workers = workers or encode_workers
+
+    # a couple of bands per worker to even out the load, but no smaller
+    # than min_band_bytes
+    rows = max(1, min_band_bytes // (stride + 1), -(-height // (workers * 2)))
+    bands = [(top, min(height, top + rows)) for top in range(0, height, rows)]
+
+    # already on the encode pool (encoding one of several images), waiting
+    # on more work queued behind this could deadlock
+    on_pool = threading.current_thread().name.startswith("rackdiagram-encode")
+
+    if len(bands) == 1 or workers == 1 or on_pool:
+        results = [_deflate_band(img, top, bottom, stride, compress_level, bottom == height)
+                   for top, bottom in bands]
+    else:
+        executor = get_encode_executor()
+        futures = [executor.submit(_deflate_band, img, top, bottom, stride,
+                                   compress_level, bottom == height)
+                   for top, bottom in bands]
+        results = [f.result() for f in futures]
+
+    adler = 1
+    for _, band_adler, length in results:
+        adler = _adler32_combine(adler, band_adler, length)
+
+    fp.write(b"\x89PNG\r\n\x1a\n")
+    _chunk(fp, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+    # zlib header for deflate with a 32K window and the default level
+    _chunk(fp, b"IDAT", b"\x78\x9c" + b"".join(r[0] for r in results) + struct.pack(">I", adler))
+    _chunk(fp, b"IEND", b"")
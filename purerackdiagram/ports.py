@@ -0,0 +1,54 @@
+"""Compiled port tables.
+
+The ports for each image in config.yaml are compiled once into a PortTable,
+a tuple of (fields, x, y) rows where fields is a private copy of the config
+port that is never handed out.  Placing an image's ports at an offset is
+then one pass building the new port dicts, rather than looking the ports up
+in the config and copying and patching each one.
+"""
+
+
+class PortTable():
+    """The ports of one image, read only"""
+
+    __slots__ = ('key', 'rows')
+
+    def __init__(self, key, ports):
+        self.key = key
+        # the copy keeps loc in its place so the json key order doesn't change
+        self.rows = tuple((dict(p), p['loc'][0], p['loc'][1]) for p in ports)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def at_offset(self, offset, additional_keys=None):
+        """Returns new port dicts moved by offset, with additional_keys added"""
+        ox, oy = offset
+        if additional_keys:
+            return [{**fields, 'loc': (x + ox, y + oy), **additional_keys}
+                    for fields, x, y in self.rows]
+
+        ports = []
+        for fields, x, y in self.rows:
+            port = fields.copy()
+            port['loc'] = (x + ox, y + oy)
+            ports.append(port)
+        return ports
+
+
+def compile_port_tables(config):
+    """PortTables for every image key in config that has ports"""
+    return {key: PortTable(key, info['ports'])
+            for key, info in config.items()
+            if isinstance(info, dict) and info.get('ports')}
+
+
+def shift_ports(ports, x_offset, y_offset):
+    """Returns copies of ports moved by (x_offset, y_offset)"""
+    shifted = []
+    for p in ports:
+        port = p.copy()
+        x, y = p['loc']
+        port['loc'] = (x + x_offset, y + y_offset)
+        shifted.append(port)
+    return shifted
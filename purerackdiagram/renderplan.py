@@ -0,0 +1,171 @@
+"""Render plans.
+
+Each component (FA chassis, FA shelf, FB and FB-S chassis, XFM) is first
+worked out as a plan, what gets drawn where, and only then drawn by
+execute_plan().  A plan is plain json serialisable data:
+
+    {'base': asset key the component is drawn on,
+     'size': [width, height] from the config, None if it isn't there,
+     'ops': [op, ...] in the order they are drawn,
+     'ports': the ports of the component,
+     'config_updates': {name: value} the config gets, see apply_config_updates()}
+
+The ops are
+
+    ['paste', sprite, [x, y]]
+    ['text', [x, y], text, font size, fill]
+    ['dp_label_v2', text, start loc, end loc, rotated]    apply_dp_labelv2()
+    ['dp_label', dp_size, x_offset, y_offset, right, full]  apply_dp_label()
+
+and a sprite is one of
+
+    ['asset', key]
+    ['fm', key, fm_str, fm_type, label, rotated]    get_fm_image()
+    ['label', text, font size, fill, background, angle, top_crop]    rotated_label()
+    ['plan', plan]    a component of its own, a FB-S blade
+
+Plans are cheap to build, the same diagram always gives equal plans, so
+they can be compared, hashed (plan_digest()) or laid out (plan_layout())
+without drawing anything.
+"""
+import hashlib
+import os
+
+from .canonical import canonical_json
+from .text import draw_text, rotated_label, text_bbox
+from .utils import RackImage, global_config, LayoutUnavailable, asset_size
+
+# draw plans with NumPy (blit.py) rather than Pillow, the same pixels
+numpy_blit = os.environ.get('RACKDIAGRAM_NUMPY_BLIT', '').lower() in ('1', 'true', 'yes')
+
+
+def new_plan(base):
+    """An empty plan for a component drawn on asset base"""
+    size = global_config.get(base, {}).get('size')
+    return {'base': base,
+            'size': list(size) if size else None,
+            'ops': [],
+            'ports': [],
+            'config_updates': {}}
+
+
+def asset_sprite(key):
+    return ['asset', key]
+
+
+def fm_sprite(key, fm_str, fm_type, label=True, rotated=False):
+    return ['fm', key, fm_str, fm_type, bool(label), bool(rotated)]
+
+
+def label_sprite(text, size, fill, background, angle, top_crop=0):
+    return ['label', text, size, list(fill), list(background), angle, top_crop]
+
+
+def plan_sprite(plan):
+    return ['plan', plan]
+
+
+def paste_op(sprite, xy):
+    return ['paste', sprite, list(xy)]
+
+
+def text_op(xy, text, size, fill):
+    return ['text', list(xy), text, size, list(fill)]
+
+
+def centered_text_op(text, x_loc, y_loc, size, fill=(199, 89, 40)):
+    """text centred on x_loc, as apply_text() draws it"""
+    _, _, w, _ = text_bbox(text, size)
+    return text_op((x_loc - w // 2, y_loc), text, size, fill)
+
+
+def apply_config_updates(config, plan):
+    """Gives config what the plan adds to it, the module locations of each
+    datapack, in place like drawing it used to.  Lists are updated in place,
+    the diagram's config shares them with the component's copy."""
+    for name, value in plan['config_updates'].items():
+        current = config.get(name)
+        if isinstance(current, list):
+            current[:] = value
+        else:
+            config[name] = value
+
+
+def plan_layout(plan):
+    """The {'size', 'ports'} of the component, what drawing the plan in
+    json_only mode gives, raises LayoutUnavailable if that would fail"""
+    if plan['size'] is None:
+        raise LayoutUnavailable(f"No size in the config for {plan['base']}")
+    for op in plan['ops']:
+        if op[0] == 'paste':
+            sprite = op[1]
+            if sprite[0] == 'fm' and sprite[5]:
+                # rotating a module needs its size
+                asset_size(sprite[1])
+            elif sprite[0] == 'plan':
+                plan_layout(sprite[1])
+    return {'size': tuple(plan['size']), 'ports': plan['ports']}
+
+
+def plan_digest(plans):
+    """A hash of plans, equal plans draw the same image"""
+    return hashlib.sha256(canonical_json(plans).encode()).hexdigest()
+
+
+async def sprite_image(sprite, json_only=False):
+    """The image of sprite, shared, paste it rather than drawing on it"""
+    # the flash module helpers live with the FlashArray, which builds its
+    # plans with this module
+    from .flasharray import get_fm_image
+
+    kind = sprite[0]
+    if kind == 'asset':
+        return await RackImage(sprite[1], json_only).get_sprite()
+    if kind == 'fm':
+        _, key, fm_str, fm_type, label, rotated = sprite
+        return await get_fm_image(key, fm_str, fm_type, label, rotated, json_only=json_only)
+    if kind == 'label':
+        _, text, size, fill, background, angle, top_crop = sprite
+        return rotated_label(text, size, tuple(fill), tuple(background), angle, top_crop)
+    if kind == 'plan':
+        return await execute_plan(sprite[1], json_only)
+    raise ValueError(f"Unknown sprite {kind}")
+
+
+async def execute_plan(plan, json_only=False):
+    """Draws the plan, returns the image.
+
+    Each different sprite is made once however many times it's pasted.
+    With json_only the images are MockImages, only their sizes are real.
+    RACKDIAGRAM_NUMPY_BLIT draws it with blit.execute_plan_numpy() instead
+    when NumPy is installed.
+    """
+    if not plan['ops']:
+        # nothing drawn on it, share the cached asset
+        return await RackImage(plan['base'], json_only).get_sprite()
+
+    if numpy_blit and not json_only:
+        from . import blit
+        if blit.available:
+            return await blit.execute_plan_numpy(plan)
+
+    from .flasharray import apply_dp_label, apply_dp_labelv2
+
+    img = await RackImage(plan['base'], json_only).get_image()
+    sprites = {}
+    for op in plan['ops']:
+        kind = op[0]
+        if kind == 'paste':
+            key = canonical_json(op[1])
+            if key not in sprites:
+                sprites[key] = await sprite_image(op[1], json_only)
+            img.paste(sprites[key], tuple(op[2]))
+        elif kind == 'text':
+            draw_text(img, tuple(op[1]), op[2], op[3], tuple(op[4]))
+        elif kind == 'dp_label_v2':
+            img = apply_dp_labelv2(img, *op[1:])
+        elif kind == 'dp_label':
+            img = apply_dp_label(img, *op[1:])
+        else:
+            raise ValueError(f"Unknown render plan op {kind}")
+    return img
@@ -0,0 +1,183 @@
+"""Cache of finished results.
+
+The same requests (the default UI load, popular models ...) come in over and
+over and used to be rendered from scratch every time.  ResultCache keeps
+finished results keyed by a hash of the request parameters and the version
+of the code, config and assets that produced them, in two tiers:
+
+ - memory, a byte budgeted LRUCache for the life of the process
+ - disk, one json file per result in a directory (/tmp in lambda) that
+   outlives the process for as long as the container does.
+
+Values must be json serialisable, a lambda response dict is.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from .cache import LRUCache
+from .canonical import canonical_json
+
+logger = logging.getLogger()
+
+root_path = os.path.dirname(__file__)
+
+
+def code_version(extra_paths=()):
+    """A hash of the name, size and mtime of every file in the package.
+
+    Any change to the code, config.yaml or an asset changes it, so results
+    rendered by a different version are never served.
+    """
+    h = hashlib.sha256()
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root_path):
+        dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+    paths.extend(extra_paths)
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        h.update(f"{os.path.relpath(path, root_path)}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+    return h.hexdigest()
+
+
+class ResultCache():
+    """Finished results in a memory LRU backed by a directory of json files.
+
+    disk_dir None (or disk_bytes 0) turns the disk tier off, memory_bytes 0
+    the memory tier.
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0, version="", name="results"):
+        self.name = name
+        self.version = version
+        self.memory = LRUCache(memory_bytes, name=name)
+        self.disk_dir = disk_dir if disk_bytes > 0 else None
+        self.disk_bytes = disk_bytes
+        self.disk_hits = 0
+        self.disk_writes = 0
+        self._disk_lock = threading.Lock()
+        self._disk_used = None
+
+    def key(self, params):
+        """The cache key for a set of request params.
+
+        params can be anything json serialisable, pass them in canonical form
+        (canonical_config ...) so equivalent requests share a key.
+        """
+        return hashlib.sha256(f"{self.version}\0{canonical_json(params)}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.disk_dir is None:
+            return value
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            value = json.loads(data)
+        except ValueError:
+            logger.warning(f"Dropping unreadable result cache file {self._path(key)}")
+            self._remove(self._path(key))
+            return None
+
+        with self._disk_lock:
+            self.disk_hits += 1
+        # keep the last use time for eviction
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        self.memory.put(key, value, len(data))
+        return value
+
+    def put(self, key, value):
+        data = json.dumps(value, separators=(',', ':')).encode()
+        self.memory.put(key, value, len(data))
+        if self.disk_dir is None or len(data) > self.disk_bytes:
+            return
+
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # written to a temp file and renamed so readers never see half a file
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"Could not write result cache file: {e}")
+            return
+
+        with self._disk_lock:
+            self.disk_writes += 1
+            if self._disk_used is None:
+                self._disk_used = self._scan_disk()[1]
+            else:
+                self._disk_used += len(data)
+            if self._disk_used > self.disk_bytes:
+                self._evict_disk()
+
+    def _scan_disk(self):
+        files = []
+        total = 0
+        try:
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.json'):
+                        st = entry.stat()
+                        files.append((st.st_mtime_ns, entry.path, st.st_size))
+                        total += st.st_size
+        except OSError:
+            pass
+        return files, total
+
+    def _evict_disk(self):
+        # caller must hold _disk_lock, drops the least recently used files
+        # until the directory is back under 3/4 of the budget
+        files, total = self._scan_disk()
+        files.sort()
+        for _, path, size in files:
+            if total <= self.disk_bytes * 3 // 4:
+                break
+            if self._remove(path):
+                total -= size
+        self._disk_used = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk_dir is not None:
+            with self._disk_lock:
+                for _, path, _ in self._scan_disk()[0]:
+                    self._remove(path)
+                self._disk_used = 0
+
+    def stats(self):
+        stats = self.memory.stats()
+        with self._disk_lock:
+            stats.update({
+                'disk_dir': self.disk_dir,
+                'disk_hits': self.disk_hits,
+                'disk_writes': self.disk_writes,
+                'disk_bytes': self._disk_used,
+                'max_disk_bytes': self.disk_bytes,
+            })
+        return stats
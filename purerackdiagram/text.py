@@ -0,0 +1,92 @@
+"""Cached fonts and rendered text.
+
+The same few strings (model names, FM sizes, datapack sizes ...) are drawn
+over and over, every label used to open the ttf again and rasterise the
+string from scratch.  Fonts are kept per size and the rasterised text masks
+and rotated labels are kept in a byte budgeted LRU, drawing a label is then
+just a paste.
+
+draw_text() gives exactly the same pixels as ImageDraw.text, it pastes the
+same mask that ImageDraw.text renders with the same ink.  The fractional
+part of the position changes the rasterised mask so it's part of the key.
+"""
+import functools
+import math
+import os
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .cache import LRUCache, image_nbytes
+
+root_path = os.path.dirname(__file__)
+ttf_path = os.path.join(root_path, "Lato-Regular.ttf")
+
+text_cache_mb = int(os.environ.get('RACKDIAGRAM_TEXT_CACHE_MB', 16))
+text_cache = LRUCache(text_cache_mb * 1024 * 1024, name="text")
+
+
+@functools.lru_cache(maxsize=32)
+def get_font(size):
+    """The Lato font at size, each size is only loaded once"""
+    return ImageFont.truetype(ttf_path, size=size)
+
+
+@functools.lru_cache(maxsize=1024)
+def text_bbox(text, size, mode="L"):
+    """Same as ImageDraw.textbbox((0, 0), text, font) for the font at size"""
+    return get_font(size).getbbox(text, mode)
+
+
+def text_mask(text, size, start=(0.0, 0.0)):
+    """The rasterised text as an L mode image and the offset to paste it at"""
+    key = ('mask', text, size, start)
+    mask = text_cache.get(key)
+    if mask is None:
+        core, offset = get_font(size).getmask2(text, "L", start=start)
+        # wrap the core image without copying it
+        mask = (Image.Image()._new(core), offset)
+        text_cache.put(key, mask, image_nbytes(mask[0]))
+    return mask
+
+
+def _placed_mask(xy, text, size):
+    start = (math.modf(xy[0])[0], math.modf(xy[1])[0])
+    mask, offset = text_mask(text, size, start)
+    x = int(xy[0]) + offset[0]
+    y = int(xy[1]) + offset[1]
+    return mask, (x, y, x + mask.size[0], y + mask.size[1])
+
+
+def text_box(xy, text, size):
+    """The (left, top, right, bottom) pixels draw_text() would touch"""
+    return _placed_mask(xy, text, size)[1]
+
+
+def draw_text(img, xy, text, size, fill):
+    """Draws text onto img at xy, like ImageDraw.Draw(img).text(xy, text, fill, font)"""
+    if not isinstance(img, Image.Image):
+        # MockImage in json_only mode
+        return
+
+    mask, box = _placed_mask(xy, text, size)
+    if mask.size[0] == 0 or mask.size[1] == 0:
+        return
+    img.paste(fill, box, mask)
+
+
+def rotated_label(text, size, fill, background, angle, top_crop=0):
+    """A label image, text on a solid background cropped and rotated.
+
+    The result is shared, paste it into something else rather than drawing
+    on it.
+    """
+    key = ('label', text, size, fill, background, angle, top_crop)
+    label = text_cache.get(key)
+    if label is None:
+        _, _, w, h = text_bbox(text, size, mode="")
+        label = Image.new("RGBA", (w, h), background)
+        ImageDraw.Draw(label).text((0, 0), text, font=get_font(size), fill=fill)
+        label = label.crop((0, top_crop, w, h))
+        label = label.rotate(angle, expand=1)
+        text_cache.put(key, label, image_nbytes(label))
+    return label
@@ -1,20 +1,48 @@
-import yaml
+import re
 import asyncio
-import concurrent
-# import time
+import concurrent.futures
+import threading
+import time
 import logging
 from PIL import Image
 from PIL import ImageDraw
-from PIL import ImageFont
 from PIL import ImageTransform
 # from io import BytesIO
 import os
 import purerackdiagram
+from .cache import LRUCache, image_nbytes
+from . import assetpack
+from . import configcache
+from .ports import compile_port_tables, shift_ports
+from .text import draw_text, get_font, text_bbox
 
 logger = logging.getLogger()
 
-cache = {}
-cache_lock = asyncio.Lock()
+# decoded images are kept in a byte budgeted LRU so a warm container
+# doesn't hold every chassis it has ever seen in memory.
+asset_cache_mb = int(os.environ.get('RACKDIAGRAM_ASSET_CACHE_MB', 256))
+cache = LRUCache(asset_cache_mb * 1024 * 1024, name="assets")
+
+# futures for keys currently being decoded, so a second request for the
+# same key (from any thread or event loop) waits on the first load instead
+# of decoding it again.
+loading = {}
+loading_lock = threading.Lock()
+
+# one long lived pool for all asset decoding, rather than a new pool
+# per image.  Sized to the cpu count unless RACKDIAGRAM_DECODE_WORKERS is set.
+decode_workers = int(os.environ.get('RACKDIAGRAM_DECODE_WORKERS', 0)) or os.cpu_count() or 1
+decode_executor = None
+decode_executor_lock = threading.Lock()
+decode_metrics = {
+    'queued': 0,
+    'active': 0,
+    'decoded': 0,
+    'decode_seconds': 0.0,
+    'decode_seconds_max': 0.0,
+    'queue_wait_seconds': 0.0,
+}
+decode_metrics_lock = threading.Lock()
 root_path = os.path.dirname(purerackdiagram.__file__)
 ttf_path = os.path.join(root_path, "Lato-Regular.ttf")
 
@@ -112,11 +140,16 @@ class MockImageDraw:
         text_len = len(str(text)) if text else 0
         return (0, 0, text_len * 10, 20)  # fake width based on text length
 
-global_config = None
-with open(os.path.join(root_path, 'config.yaml'), 'r') as f:
-    global_config = yaml.full_load(f)
+global_config = configcache.load_config()
 global_config['ttf_path'] = ttf_path
 
+# the ports of every image, compiled once, see ports.py
+port_tables = compile_port_tables(global_config)
+
+# memory mapped raw RGBA assets, None unless the pack has been built,
+# see assetpack.py
+asset_pack = assetpack.open_pack()
+
 # Custom exceptions for better error handling
 class RackDiagramException(Exception):
     """Base exception class for all rack diagram errors"""
@@ -130,16 +163,175 @@ class InvalidDatapackException(InvalidConfigurationException):
     """Exception specifically for datapack validation errors"""
     pass
 
+class LayoutUnavailable(Exception):
+    """The layout can't be worked out from the config alone, the images have
+    to be built to get it (or to fail the way building them does)"""
+    pass
+
+
+
+def load_asset(path):
+    """Open and fully decode a png, converting it to RGBA"""
+    img = Image.open(path)
+
+    # check and convet to RGBA:
+    if img.format == 'PNG':
+        # and is not RGBA
+        if not img.mode == 'RGBA':
+            logger.debug(f"!!Converting image {path} to RGBA")
+            img = img.convert("RGBA")
+        else:
+            logger.debug(f"Image {path} already in RGBA")
+    img.load()
+
+    logger.debug("Loaded: {}".format(path))
+    return img
+
+
+def _finish_load(key, future):
+    # runs in the decode thread once the future completes, the cache
+    # is populated before the key is removed from loading so there is
+    # no window where neither has it.
+    if future.exception() is None:
+        img = future.result()
+        cache.put(key, img, image_nbytes(img))
+    with loading_lock:
+        if loading.get(key) is future:
+            del loading[key]
+
+
+def get_decode_executor():
+    """Returns the process wide executor used to decode assets"""
+    global decode_executor
+    with decode_executor_lock:
+        if decode_executor is None:
+            decode_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=decode_workers,
+                thread_name_prefix="rackdiagram-decode")
+        return decode_executor
+
+
+def configure_decode_executor(max_workers):
+    """Resize the decode executor, the old pool finishes what it has queued"""
+    global decode_executor, decode_workers
+    with decode_executor_lock:
+        old_executor = decode_executor
+        decode_workers = max_workers
+        decode_executor = None
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def _reset_decode_executor():
+    # threads don't survive a fork, the child has to build its own pool
+    global decode_executor
+    decode_executor = None
+
+
+os.register_at_fork(after_in_child=_reset_decode_executor)
+
+
+def get_decode_metrics():
+    """Queue depth and decode timing for the decode executor"""
+    with decode_metrics_lock:
+        metrics = dict(decode_metrics)
+    metrics['workers'] = decode_workers
+    return metrics
+
+
+def _timed_load_asset(path, submitted):
+    started = time.perf_counter()
+    with decode_metrics_lock:
+        decode_metrics['queued'] -= 1
+        decode_metrics['active'] += 1
+        decode_metrics['queue_wait_seconds'] += started - submitted
+    try:
+        return load_asset(path)
+    finally:
+        elapsed = time.perf_counter() - started
+        with decode_metrics_lock:
+            decode_metrics['active'] -= 1
+            decode_metrics['decoded'] += 1
+            decode_metrics['decode_seconds'] += elapsed
+            decode_metrics['decode_seconds_max'] = max(decode_metrics['decode_seconds_max'], elapsed)
+        logger.debug(f"Decoded {path} in {elapsed:.4f}s")
+
+
+def get_asset_future(key):
+    """Returns a concurrent.futures.Future for the decoded image of key.
+
+    Only one decode per key is ever in flight, every caller asking for a key
+    that is already loading gets the same future.  These futures aren't tied
+    to an event loop so they can be waited on from any thread, or awaited
+    from any loop with asyncio.wrap_future.
+    """
+    # pre-decoded pack, these are just wrappers around the mapped file
+    # so they don't need to go through the cache.
+    if asset_pack is not None:
+        img = asset_pack.get(key)
+        if img is not None:
+            future = concurrent.futures.Future()
+            future.set_result(img)
+            return future
+
+    with loading_lock:
+        future = loading.get(key)
+        if future is not None:
+            return future
+
+        img = cache.get(key)
+        if img is not None:
+            future = concurrent.futures.Future()
+            future.set_result(img)
+            return future
+
+        # reading through asyncIO, it seems some OS
+        # implementations are not truly Async!!!
+        # now i'm going back to threads...
+        with decode_metrics_lock:
+            decode_metrics['queued'] += 1
+        future = get_decode_executor().submit(
+            _timed_load_asset, os.path.join(root_path, key), time.perf_counter())
+        loading[key] = future
+
+    future.add_done_callback(lambda f: _finish_load(key, f))
+    return future
+
+
+def read_only_handle(img):
+    """Returns a new Image object sharing the pixels of img, marked read only.
+
+    Pillow copies a read only image before pasting or drawing on it, so
+    writing to the handle gives the writer its own copy and never changes
+    img.  Reading from it (pasting it somewhere else, rotate, crop) costs
+    nothing extra.
+    """
+    handle = img._new(img.im)
+    handle.readonly = 1
+    return handle
+
+
+def pixels_id(img):
+    """An id shared by img and every read_only_handle() of the same pixels
+
+    Identical components are handed out as handles to the same pixels, this
+    spots them so they are only converted, scaled or encoded once.  Only
+    meaningful while the images are alive.
+    """
+    if isinstance(img, Image.Image):
+        return id(img.im)
+    return id(img)
 
 
 class RackImage():
-    """This loads a file from disk and caches it.  If it's already been
-    loaded it returns the cached object.  Originally, we were loading
-    images from an S3 bucket, however, now to
-    improve performance images are loaded
-    directly from local FS.  So the benefit of this caching is questionable
-    but is already written.  Probably could replace this whole class
-    with img = Image.open(key)  lol!
+    """This loads a png from disk and caches the decoded image in the
+    asset cache.  Loading is single flight per key and doesn't keep any
+    event loop state, so RackImage can be used from any loop or thread.
+
+    get_image() returns a private copy, use it for base images that
+    get pasted onto or drawn on.  get_sprite() returns a copy on write
+    handle to the cached pixels, use it for images that are only pasted
+    into something else (FMs, pci cards, psus ...).
     """
 
     def __init__(self, key, json_only=False):
@@ -148,67 +340,130 @@ class RackImage():
         # key is the file name, s3 terminology.
         self.key = os.path.join(root_path, key)
         self.original_key = key
-        self.img = None
         self.json_only = json_only
-        self.io_lock = asyncio.Lock()
-
-        # on object creation, see if this key has laready been requested.
-        # potential race, if two object check but... worst case is we miss
-        # a caching opportunity and just load twice.
-        cache_key = f"{key}_{json_only}"
-        if cache_key in cache and not json_only:
-            self.primary = False
-            self.primary_obj = cache[cache_key]
-        else:
-            cache[cache_key] = self
-            self.primary = True
+
+    async def _get_cached_image(self):
+        return await asyncio.wrap_future(get_asset_future(self.original_key))
 
     async def get_image(self):
-        if not self.primary and not self.json_only:
-            return await self.primary_obj.get_image()
+        if self.json_only:
+            # Create MockImage from config size data
+            logger.debug("Created MockImage for: {}".format(self.key))
+            return MockImage.from_config(self.key)
 
-        # could be called by primary and secondary
-        # objects, so secondary must wait here
-        async with self.io_lock:
+        img = await self._get_cached_image()
+        return img.copy()
 
-            # same image may be requested multiple times
-            # when secondary comes through need to
-            # return image that's already loaded
-            
-            if self.img and not self.json_only:
-                return self.img.copy()
+    async def get_sprite(self):
+        if self.json_only:
+            return MockImage.from_config(self.key)
 
-            loop = asyncio.get_event_loop()
+        img = await self._get_cached_image()
+        return read_only_handle(img)
 
-            # reading through asyncIO, it seems some OS
-            # implementations are not truly Async!!!
-            # now i'm going back to threads...
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                await loop.run_in_executor(pool, self.load_img)
 
-            
-            return self.img.copy()
+def asset_size(key):
+    """The (width, height) of asset key from the config, without loading it"""
+    info = global_config.get(key)
+    if not info or 'size' not in info:
+        # json_only mode can't build this component either
+        raise LayoutUnavailable(f"No size in the config for {key}")
+    width, height = info['size']
+    return (width, height)
 
-    def load_img(self):
-        # load image from disk or create MockImage
-        if self.json_only:
-            # Create MockImage from config size data
-            self.img = MockImage.from_config(self.key)
-            logger.debug("Created MockImage for: {}".format(self.key))
+
+# extra assets for each FlashBlade family on top of its chassis images,
+# keyed by the start of the model name.  FlashArray families are worked
+# out from the generation in the model name, see preload_keys().
+fb_preload_prefixes = {
+    'fb-s': ['pure_fbs_', 'pure_fb_xfm_', 'pure_fa_fm_nvme.png'],
+    'fb-e': ['pure_fbe_', 'pure_fbs_blade.png', 'pure_fb_xfm_', 'pure_fa_fm_nvme.png'],
+    'fb': ['pure_fb_front.png', 'pure_fb_back_', 'pure_fb_xfm_'],
+}
+
+
+def asset_keys():
+    """All of the png asset keys on disk"""
+    png_dir = os.path.join(root_path, 'png')
+    return sorted(f"png/{n}" for n in os.listdir(png_dir) if n.endswith('.png'))
+
+
+def preload_keys(targets):
+    """Resolve preload targets into asset keys.
+
+    A target is "all", an asset key like "png/pure_fa_fm_nvme.png", a
+    FlashArray model or generation ("fa", "fa-x", "fa-c70r4") or a
+    FlashBlade family ("fb", "fb-s", "fb-e").  FlashArray generations also
+    get every asset that isn't a chassis image (cards, FMs, shelves ...).
+    """
+    if isinstance(targets, str):
+        targets = targets.split(',')
+
+    all_keys = asset_keys()
+    keys = []
+    for target in targets:
+        target = target.strip().lower()
+        if not target:
+            continue
+
+        if target == 'all':
+            matched = all_keys
+        elif target.endswith('.png'):
+            key = target if target.startswith('png/') else f"png/{target}"
+            if key not in all_keys:
+                raise InvalidConfigurationException(f"Unknown asset to preload: {target}")
+            matched = [key]
+        elif target == 'fa':
+            matched = [k for k in all_keys if k.startswith('png/pure_fa_')]
+        elif target.startswith('fa-'):
+            generation = re.match(r'fa-(rc|xl|[a-z])', target)
+            if generation is None:
+                raise InvalidConfigurationException(f"Unknown model to preload: {target}")
+            prefix = f"png/pure_fa_{generation.group(1)}_"
+            matched = [k for k in all_keys if k.startswith(prefix) or (
+                k.startswith('png/pure_fa_') and not re.match(r'png/pure_fa_[a-z]+_r\d', k))]
         else:
-            self.img = Image.open(self.key)
-            
-            # check and convet to RGBA:
-            if self.img.format == 'PNG':
-                # and is not RGBA
-                if not self.img.mode == 'RGBA':
-                    logger.debug("!!Converting image {self.key} to RGBA")
-                    self.img = self.img.convert("RGBA")
-                else:
-                    logger.debug("Image {self.key} already in RGBA")
-            self.img.load()
-               
-            logger.debug("Loaded: {}".format(self.key))
+            for family, prefixes in fb_preload_prefixes.items():
+                if target.startswith(family):
+                    matched = [k for k in all_keys if any(k.startswith(f"png/{p}") for p in prefixes)]
+                    break
+            else:
+                raise InvalidConfigurationException(f"Unknown model to preload: {target}")
+
+        keys.extend(k for k in matched if k not in keys)
+    return keys
+
+
+def preload(targets="all", wait=True):
+    """Decode assets into the asset cache ahead of the first request.
+
+    Meant for the lambda init phase (or a warm up invocation) so the first
+    real request doesn't pay for decoding.  targets is anything
+    preload_keys() accepts.  The decodes go through the shared decode
+    executor, with wait=False this returns as soon as they are queued.
+    Returns the list of keys that were preloaded.
+    """
+    keys = preload_keys(targets)
+
+    # the font sizes used for labels
+    for size in (15, 24, 85):
+        get_font(size)
+
+    futures = [get_asset_future(key) for key in keys]
+    if wait:
+        for key, future in zip(keys, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Failed to preload {key}: {e}")
+
+        stats = cache.stats()
+        if stats['evictions'] and stats['bytes'] >= stats['max_bytes'] * 0.9:
+            logger.warning(f"Preloaded assets don't fit in the asset cache ({asset_cache_mb} MiB), "
+                           "raise RACKDIAGRAM_ASSET_CACHE_MB or preload fewer families")
+
+    logger.info(f"Preloaded {len(keys)} assets")
+    return keys
 
 
 def bool_param_get(config, key, default=False):
@@ -224,98 +479,172 @@ def bool_param_get(config, key, default=False):
             raise InvalidConfigurationException(f"Invalid boolean value for parameter '{key}': '{config[key]}'. Expected: true, false, 1, 0, yes, no")
     return default
 
+def render_scale(params, size):
+    """The scale the 'scale' and 'max_width' params ask for, for an image of size
+
+    1.0 when neither is given, images are only ever scaled down.
+    """
+    scale = 1.0
+    if str(params.get('scale', '')).strip() != '':
+        try:
+            scale = float(params['scale'])
+        except ValueError:
+            raise InvalidConfigurationException(f"Invalid value for parameter 'scale': '{params['scale']}'. Expected a number greater than 0 and at most 1")
+        if not 0 < scale <= 1:
+            raise InvalidConfigurationException(f"Invalid value for parameter 'scale': '{params['scale']}'. Expected a number greater than 0 and at most 1")
+
+    if str(params.get('max_width', '')).strip() != '':
+        try:
+            max_width = int(params['max_width'])
+        except ValueError:
+            max_width = 0
+        if max_width <= 0:
+            raise InvalidConfigurationException(f"Invalid value for parameter 'max_width': '{params['max_width']}'. Expected a whole number of pixels")
+        if size[0] > max_width:
+            # the extra half pixel makes sure the width doesn't round down
+            # to max_width - 1
+            scale = min(scale, (max_width + 0.5) / size[0])
+
+    return scale
+
 def add_ports_at_offset(key, offset, all_ports, additional_keys={}):
-    global global_config
+    """Appends the ports of image key to all_ports, moved by offset"""
+    table = port_tables.get(key)
+    if table is not None:
+        all_ports.extend(table.at_offset(offset, additional_keys))
 
-    additional_keys = additional_keys.copy()
-        
-    if key in global_config:
-        if 'ports' in global_config[key]:
-            ports = global_config[key]['ports']
-            for p in ports:
-                new_port = p.copy()
+def stack_layout(components):
+    """Where the components go stacked top to bottom and centred.
+
+    components is a list of (size, ports).  Returns the combined
+    (width, height), the (x, y) of each component and the ports moved to
+    their place in the combined image.
+    """
+    widths, heights = zip(*(size for size, _ in components))
+    total_width = max(widths)
+
+    y_offset = 0
+    offsets = []
+    all_ports = []
+    for size, ports in components:
+        # center the x difference if an image is slightly smaller width
+        x_offset = int((total_width - size[0]) / 2)
+        offsets.append((x_offset, y_offset))
+
+        #calculate new port location
+        all_ports.extend(shift_ports(ports, x_offset, y_offset))
+
+        y_offset += size[1]
+
+    return (total_width, sum(heights)), offsets, all_ports
+
+
+def vertical_layout(image_ports):
+    """Where combine_images_vertically() places each image.
+
+    Returns the combined (width, height), a list of (img, x, y) placements
+    and the ports moved to their place in the combined image.
+    """
+    size, offsets, all_ports = stack_layout([(i['img'].size, i['ports']) for i in image_ports])
+    placements = [(i['img'], x, y) for i, (x, y) in zip(image_ports, offsets)]
+    return size, placements, all_ports
+
+
+def scaled_size(size, scale):
+    """The size of an image of size scaled by scale, as the combined images are"""
+    return (int(size[0] * scale), int(round(size[1] * scale)))
+
+
+def fit_scale(size, max_height):
+    """The scale that brings an image of size down to max_height, 1.0 if it fits"""
+    if size[1] > max_height:
+        return max_height / float(size[1])
+    return 1.0
 
 
-                new_loc = (p['loc'][0] + offset[0], p['loc'][1] + offset[1])
-                new_port['loc'] = new_loc
-                # add additional keys
-                
-                for k in additional_keys:
-                    new_port[k] = additional_keys[k]
+def scale_ports(ports, scale):
+    """Moves ports to where they are in the image scaled by scale, in place"""
+    for p in ports:
+        p['loc'] = (int(p['loc'][0] * scale), int(p['loc'][1] * scale))
 
-                all_ports.append(new_port)
 
-def combine_images_vertically(image_ports):
+def combine_images_vertically(image_ports, scale=1.0):
     """ Combines a list of PIL images vertically
         Args:
             images: List of PIL image objects to be combined
+            scale: compose the result at this scale rather than scaling the
+                   full size result, see _paste_scaled()
     """
-    # pull out the images
-    images = [ i['img'] for i in image_ports]
-    widths, heights = zip(*(i.size for i in images))
-    total_height = sum(heights)
-    total_width = max(widths)
-
     logger.debug("Combining images vertically")
-    
+    size, placements, all_ports = vertical_layout(image_ports)
+    if scale != 1.0:
+        # the same size and port locations resizing the full image gives
+        size = scaled_size(size, scale)
+        scale_ports(all_ports, scale)
+
     # Check if all images are MockImages
-    all_mock = all(isinstance(img, MockImage) for img in images)
-    any_mock = any(isinstance(img, MockImage) for img in images)
-    
+    all_mock = all(isinstance(p[0], MockImage) for p in placements)
+    any_mock = any(isinstance(p[0], MockImage) for p in placements)
+
     if all_mock:
         # Create a MockImage for the combined result
-        new_im = MockImage((total_width, total_height))
+        return MockImage(size, "RGB"), all_ports
     elif any_mock:
         # Mixed images - this shouldn't happen, but handle gracefully
         logger.error("Mixed MockImage and PIL Images detected, forcing MockImage mode")
-        new_im = MockImage((total_width, total_height))
+        return MockImage(size, "RGB"), all_ports
+
+    # RGB to reduce file size.  Pasting RGBA into RGB copies the colour and
+    # drops the alpha, the same as pasting into an RGBA canvas and converting
+    # it, without a second full size copy of the rack.
+    new_im = Image.new("RGB", size)
+    if scale != 1.0:
+        _paste_scaled(new_im, placements, scale)
     else:
-        # Regular PIL image combination
-        new_im = Image.new("RGBA", (total_width, total_height))
-
-    y_offset = 0
-    all_ports = []
-    for imp in image_ports:
-        im = imp['img']
-        ports = imp['ports']
-
-        # center the x difference if an image is slightly smaller width
-        x_offset = int((total_width - im.size[0]) / 2)
-        
-        new_im.paste(im, (x_offset, y_offset))
-
-        
-        #calculate new port location
-        for p in ports:
-            new_port = p.copy()
-            new_loc = (p['loc'][0] + x_offset, p['loc'][1] + y_offset)
-            new_port['loc'] = new_loc
-            all_ports.append(new_port)
-
-        y_offset += im.size[1]
-
-    #convert from RGBA to RGB to reduce file size
-    logger.debug("Converting image to RGB")
-    new_im = new_im.convert('RGB')  # Works for both PIL Images and MockImages
+        for im, x_offset, y_offset in placements:
+            new_im.paste(im, (x_offset, y_offset))
 
     return new_im, all_ports
 
 
-def apply_text(img, text, x_loc, y_loc, font_size=15, rotate_degrees=0):
-    global ttf_path
+def _paste_scaled(new_im, placements, scale):
+    """Pastes each image scaled into new_im, in place of a full size canvas.
 
-    draw = ImageDraw.Draw(img)
-    font = ImageFont.truetype(ttf_path, size=font_size)
-    #w, _ = draw.textsize(text, font=font)
+    Every image covers the rows its full size edges round to so the images
+    still meet exactly.  Shrinking goes through Image.reduce() by whole
+    factors first (reducing_gap), the mipmap of the image, before LANCZOS
+    takes it to the exact size.  The result only differs from resizing the
+    full size image along the seams, where LANCZOS no longer reads across
+    from the neighbouring image.
+    """
+    # identical components share their pixels, they are scaled once for
+    # each size they come out at
+    scaled_images = {}
+    for im, x_offset, y_offset in placements:
+        top = int(round(y_offset * scale))
+        bottom = int(round((y_offset + im.size[1]) * scale))
+        left = int(round(x_offset * scale))
+        width = min(int(round(im.size[0] * scale)), new_im.size[0] - left)
+        if bottom <= top or width <= 0:
+            continue
+        key = (pixels_id(im), width, bottom - top)
+        scaled = scaled_images.get(key)
+        if scaled is None:
+            if im.mode != "RGB":
+                # resizing RGBA weights by alpha, the full size image is RGB
+                im = im.convert("RGB")
+            scaled = im.resize((width, bottom - top), Image.Resampling.LANCZOS,
+                               reducing_gap=1.0)
+            scaled_images[key] = scaled
+        new_im.paste(scaled, (left, top))
 
-    _, _, w, _ = draw.textbbox((0,0), text=text, font=font)
-    #if w != w_new:
-    #    Exception("Wrong new w")
 
+def apply_text(img, text, x_loc, y_loc, font_size=15, rotate_degrees=0):
+    _, _, w, _ = text_bbox(text, font_size)
 
     x_loc = x_loc - w // 2
     
-    draw.text((x_loc, y_loc), text, fill=(199, 89, 40), font=font)
+    draw_text(img, (x_loc, y_loc), text, font_size, (199, 89, 40))
 
 
 def apply_text_centered(img, text, y_loc, font_size=15):
@@ -363,8 +692,9 @@ def draw_skewed_text(image, location, text, font, skew_angle=15, fill="red"):
         resample=Image.Resampling.BICUBIC
     )
 
-    # Paste the skewed text image onto the original image at the specified location
-    image = image.convert("RGBA")  # Ensure the base image supports alpha
+    # Composite just the text's region, in place unless image needs converting to RGBA
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
     image.alpha_composite(skewed_text_image, (location[0], location[1]))
 
     return image
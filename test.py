@@ -778,9 +778,123 @@ def test_all(args):
     print(f"  python test_compare.py {output_filename} --validation test_validation.json")
 
 
+def test_threads(args):
+    """
+    Render the same diagrams from many threads at once, each thread goes through
+    lambdaentry.handler which runs its own event loop, so this exercises the shared
+    asset cache from several threads and loops concurrently.  Every result has to
+    match a serial render of the same parameters.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    all_items = list(get_all_tests())
+    if args.filter:
+        filter_text = args.filter.lower()
+        all_items = [item for item in all_items if filter_text in json.dumps(item).lower()]
+
+    limit = args.limit if args.limit is not None else 40
+    # spread the picks over the whole list so we get a mix of FA / FB / front / back
+    step = max(1, len(all_items) // limit)
+    items = all_items[::step][:limit]
+
+    def render(item):
+        results = lambdaentry.handler({"queryStringParameters": dict(item)}, None)
+        body = results.get('body', '')
+        if results['headers'].get('Content-Type') == 'application/json':
+            # execution_duration changes every run
+            body = json.loads(body)
+            body.pop('execution_duration', None)
+            body = json.dumps(body, sort_keys=True)
+        return results['statusCode'], hash_image(body.encode('utf-8'))
+
+    print(f"Rendering {len(items)} diagrams serially for reference")
+    clear_image_cache()
+    expected = [render(item) for item in items]
+
+    rounds = 3
+    print(f"Rendering {len(items)} diagrams x {rounds} from {args.t} threads")
+    clear_image_cache()
+    with ThreadPoolExecutor(max_workers=args.t) as pool:
+        futures = [(i, pool.submit(render, items[i])) for _ in range(rounds) for i in range(len(items))]
+
+    errors = 0
+    for i, future in futures:
+        try:
+            result = future.result()
+        except Exception:
+            errors += 1
+            print(f"ERROR: exception rendering {items[i]}")
+            traceback.print_exc()
+            continue
+        if result != expected[i]:
+            errors += 1
+            print(f"ERROR: threaded result differs from serial for {items[i]}")
+
+    print(f"Threaded renders: {len(futures)}  errors: {errors}")
+    return errors
+
+
+def test_bench(args):
+    """
+    Time drawing the render plans of a few front faces, a FlashArray row of
+    flash modules and FB-S blade grids, with Pillow (renderplan.execute_plan)
+    against NumPy (blit.execute_plan_numpy).  Both have to give the same pixels.
+    """
+    import asyncio
+    import time
+    import purerackdiagram
+    from purerackdiagram import renderplan, blit
+
+    if not blit.available:
+        print("numpy is not installed, nothing to compare")
+        return 1
+
+    items = [
+        {"model": "fa-x70r4", "datapacks": "63/63-63", "face": "front"},
+        {"model": "fa-x70r4", "datapacks": "63/63-63", "face": "front",
+         "dp_label": True, "fm_label": True},
+        {"model": "fa-xl130", "datapacks": "183/183/0/0-183", "face": "front"},
+        {"model": "fb-s200", "no_of_blades": 30, "face": "front"},
+        {"model": "fb-e", "no_of_blades": 40, "face": "front", "no_of_drives_per_blade": 4},
+    ]
+
+    async def draw(plans, execute):
+        return [await execute(plan) for plan in plans]
+
+    rounds = 10
+    errors = 0
+    for item in items:
+        plans = purerackdiagram.render_plan(item)
+        timings = {}
+        pixels = {}
+        for name, execute in (('pillow', renderplan.execute_plan), ('numpy', blit.execute_plan_numpy)):
+            # the first round loads the assets
+            asyncio.run(draw(plans, execute))
+            best = None
+            for _ in range(rounds):
+                start = time.perf_counter()
+                images = asyncio.run(draw(plans, execute))
+                took = time.perf_counter() - start
+                best = took if best is None else min(best, took)
+            timings[name] = best
+            pixels[name] = [img.tobytes() for img in images]
+        same = pixels['pillow'] == pixels['numpy']
+        if not same:
+            errors += 1
+        print(f"{json.dumps(item)}: pillow {timings['pillow'] * 1000:.1f}ms "
+              f"numpy {timings['numpy'] * 1000:.1f}ms same pixels {same}")
+
+    print(f"Compared {len(items)} diagrams  errors: {errors}")
+    return errors
+
+
 def main(args):
     if args.testtype == 'all':
         test_all(args)
+    elif args.testtype == 'threads':
+        test_threads(args)
+    elif args.testtype == 'bench':
+        test_bench(args)
     else:
         all_items = list(get_all_tests())
         print(f"Running single test at index {args.index} of {len(all_items)}")    
@@ -792,9 +906,10 @@ def main(args):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('testtype', choices=['all', 'lambda'], default='all',
+    parser.add_argument('testtype', choices=['all', 'lambda', 'threads', 'bench'], default='all',
                         nargs='?',
-                        help="Test all options, or test through lamdba entry")
+                        help="Test all options, test through lamdba entry, stress the renderer from many threads, "
+                             "or time the NumPy plan executor against Pillow")
     parser.add_argument('-t', type=int, help="number of threads", default=8)
     parser.add_argument('-i', '--index', type=int, help="Index of the test to run (0-based)", default=0)
     parser.add_argument('--limit', type=int, help="limit the total number of tests to run")
@@ -14,17 +14,6 @@ function updateApiEndpoint() {
 
 
 
-
-const pythonTupleType = new jsyaml.Type('tag:yaml.org,2002:python/tuple', {
-  kind: 'sequence',
-  construct: function (data) {
-    return data; // Treat tuples as arrays in JavaScript
-  },
-});
-
-const customSchema = jsyaml.DEFAULT_SCHEMA.extend([pythonTupleType]);
-
-
 $(function () {
   console.log("ready!");
   
@@ -41,16 +30,16 @@ $(function () {
     radio.addEventListener('change', updateApiEndpoint);
   });
 
-  fetch("config.yaml")
-  .then((response) => response.text())
-  .then((yamlText) => {
+  // config.json is written by update_config.py alongside config.yaml,
+  // same data but much faster to parse than the yaml.
+  fetch("config.json")
+  .then((response) => response.json())
+  .then((data) => {
 
     try {
-      const data = jsyaml.load(yamlText, { schema: customSchema });
-
       console.log('Loaded data:', data); // Log the loaded data
 
-      // Populate the chart with the data from the YAML file
+      // Populate the chart with the data from the config file
       const categories = ["nvme", "scm", "nvme-qlc", "sas", "blank"];
 
       const sortTable = (table, columnIndex, order) => {
@@ -196,7 +185,7 @@ $(function () {
       });
 
     } catch (error) {
-      console.error('Error loading YAML data:', error);
+      console.error('Error loading config data:', error);
     }
   });
 
@@ -533,8 +522,8 @@ $(function () {
 
       var image_src_url = null;
 
-      if ( diagram.image_type == "png" ) {
-        const img_base64encoded = await fetch(`data:image/png;base64,${diagram.image}`);
+      if ( ["png", "webp", "jpeg"].includes(diagram.image_type) ) {
+        const img_base64encoded = await fetch(`data:image/${diagram.image_type};base64,${diagram.image}`);
         const blob = await img_base64encoded.blob();
         image_src_url = await URL.createObjectURL(blob);
 
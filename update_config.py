@@ -1,4 +1,5 @@
 import yaml
+import json
 import os
 from PIL import Image
 
@@ -61,6 +62,12 @@ def main():
 
     with open('ui/config.yaml', 'w') as f:
         yaml.dump(config, f, default_flow_style=False)
+
+    # precompiled copies, loading the yaml is slow in python and in the browser
+    from purerackdiagram.configcache import write_compiled_config
+    config = write_compiled_config('purerackdiagram/config.yaml', 'purerackdiagram/config.pickle')
+    with open('ui/config.json', 'w') as f:
+        json.dump(config, f, separators=(',', ':'))
     
 
 def static_global_config():
@@ -1678,4 +1685,16 @@ def update_image_sizes(config):
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--asset-pack', dest='asset_pack', action='store_true',
+                        help="also decode every png into purerackdiagram/assets.pack")
+    args = parser.parse_args()
+
     main()
+
+    if args.asset_pack:
+        # imported after main() so the package loads the config we just wrote
+        from purerackdiagram.assetpack import build_pack
+        path, count, size = build_pack()
+        print(f"Wrote {count} assets to {path} ({size / (1024 * 1024):.1f} MiB)")